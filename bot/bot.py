@@ -1,16 +1,39 @@
 import os
+import re
+import asyncio
+import functools
 import logging
+import logging.config
+from dataclasses import dataclass
+from decimal import Decimal
+from functools import cached_property
+from typing import TYPE_CHECKING
+import orjson
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, ConversationHandler,
-    CallbackQueryHandler, MessageHandler, filters
+    CallbackQueryHandler, MessageHandler, PicklePersistence, PersistenceInput,
+    AIORateLimiter, filters
 )
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 from database.database import DB
-from stripe_utils.stripe_utils import StripeHelper
+
+if TYPE_CHECKING:
+    from stripe import HTTPXClient
+    from stripe_utils.stripe_utils import StripeHelper
+
+# uvloop is a faster drop-in event loop; PTB picks up the installed policy automatically.
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 # Import the new fallback handlers
 from .handlers import (
-    start, main_menu_handler, button_handler, rating_handler, profile, connect_stripe,
+    start, main_menu_handler, dispatch_callback, profile, connect_stripe,
     admin_verify, admin_split_funds, admin_filter,
     trade_ask_counterparty, trade_ask_description, trade_ask_amount,
     ASK_COUNTERPARTY, ASK_DESCRIPTION, ASK_AMOUNT,
@@ -20,85 +43,276 @@ from .handlers import (
     ASK_DISPUTE_REASON, ASK_DISPUTE_PROOF,
     cancel_conversation, invalid_conversation_state # Import new fallbacks
 )
+from scheduler import start_sweeper
+
+class FastFormatter(logging.Formatter):
+    """Emits one JSON object per record, skipping strftime and %-style formatting."""
+    def format(self, record):
+        entry = {"t": record.created, "lvl": record.levelname, "name": record.name, "msg": record.getMessage()}
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry).decode()
+
+# We never log thread/process info, so don't collect it for every record.
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+logging.config.dictConfig({
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {"json": {"()": FastFormatter}},
+    "handlers": {"stderr": {"class": "logging.StreamHandler", "formatter": "json"}},
+    "root": {"level": os.getenv("LOG_LEVEL", "INFO"), "handlers": ["stderr"]},
+})
+
+# Conversation entry-point patterns, compiled once and shared by their handlers.
+PAT_TRADE = re.compile(r"^start_trade$", re.ASCII)
+PAT_MILESTONE = re.compile(r"^start_milestone_project$", re.ASCII)
+PAT_DISPUTE = re.compile(r"^dispute_deal:", re.ASCII)
+
+_ENV_LOADED = False
+
+# Rendered profile pages keyed by User.id; handlers pop entries when a user's stats change.
+USER_CACHE = TTLCache(maxsize=10_000, ttl=60)
+
+def _load_env():
+    """Loads the .env file once per process, however many times build_app() runs."""
+    global _ENV_LOADED
+    if not _ENV_LOADED:
+        load_dotenv()
+        _ENV_LOADED = True
+
+@dataclass(frozen=True, slots=True)
+class BotConfig:
+    """Settings read from the environment once at startup."""
+    bot_token: str
+    stripe_secret: str
+    db_url: str
+    success_url: str
+    cancel_url: str
+    platform_fee_ratio: Decimal  # PLATFORM_FEE_PERCENT as a fraction, e.g. 0.025
+
+    @classmethod
+    def from_env(cls):
+        _load_env()
+        base_url = os.environ["BASE_URL"].rstrip("/")
+        return cls(
+            bot_token=os.environ["TELEGRAM_BOT_TOKEN"],
+            stripe_secret=os.environ["STRIPE_SECRET_KEY"],
+            db_url=os.getenv("DATABASE_URL", "sqlite:///bot.db"),
+            success_url=f"{base_url}/success.html",
+            cancel_url=f"{base_url}/cancel.html",
+            platform_fee_ratio=Decimal(os.getenv("PLATFORM_FEE_PERCENT", "0")) / 100,
+        )
+
+class PerChatRateLimiter(AIORateLimiter):
+    """
+    AIORateLimiter only throttles group chats individually. This also holds each private
+    chat to Telegram's ~1 message/second guidance, allowing a short burst of 3, so a flood
+    of notifications to one user queues here instead of coming back as 429s.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Chats idle for a minute lose their limiter so the table stays small (each use below
+        # re-inserts it, since TTLCache otherwise counts from the first insertion).
+        self._private_limiters = TTLCache(maxsize=10_000, ttl=60)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if not isinstance(chat_id, int) or chat_id < 0:
+            return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+        limiter = self._private_limiters.get(chat_id)
+        if limiter is None:
+            limiter = AsyncLimiter(3, 3)
+        self._private_limiters[chat_id] = limiter
+        async with limiter:
+            return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+def bounded(handler):
+    """
+    Wraps a handler so it runs under the bot-wide semaphore in bot_data["sem"].
+    When Stripe or Telegram slow down, extra updates wait here cheaply instead
+    of piling up as in-flight API calls.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        async with context.bot_data["sem"]:
+            return await handler(update, context)
+    return wrapper
+
+class Services:
+    """
+    External clients built on first use, so workers that only serve
+    /start or /profile never construct a Stripe client.
+    """
+    def __init__(self, stripe_secret: str):
+        self.stripe_secret = stripe_secret
+
+    @cached_property
+    def http(self) -> "HTTPXClient":
+        # The Stripe SDK is imported here rather than at module level to keep bot startup fast.
+        from stripe import HTTPXClient
+        # One pooled client for every Stripe call, so TLS handshakes are paid once.
+        return HTTPXClient(timeout=10.0, allow_sync_methods=True)
+
+    @cached_property
+    def stripe(self) -> "StripeHelper":
+        from stripe_utils.stripe_utils import StripeHelper
+        return StripeHelper(self.stripe_secret, http_client=self.http)
+
+async def _close_http(app):
+    """Closes the shared Stripe HTTP client on shutdown, if it was ever created."""
+    http = app.bot_data["services"].__dict__.get("http")
+    if http is not None:
+        http.close()
+        await http.close_async()
 
 def build_app():
     """Builds and configures the Telegram bot application."""
-    load_dotenv()
-    bot_token = os.environ["TELEGRAM_BOT_TOKEN"]
-    stripe_secret = os.environ["STRIPE_SECRET_KEY"]
-    db_url = os.getenv("DATABASE_URL", "sqlite:///bot.db")
+    config = BotConfig.from_env()
+
+    DB.init(config.db_url)
+
+    # Conversation state survives restarts. bot_data holds live clients and locks,
+    # and chat_data is unused, so only user_data and the conversations are stored.
+    persistence = PicklePersistence(
+        os.getenv("PERSISTENCE_PATH", "conv.pkl"),
+        store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+    )
 
-    DB.init(db_url)
-    stripe = StripeHelper(stripe_secret)
+    # Long polling: Telegram holds each getUpdates request open until an update
+    # arrives, so the read timeout must cover the 30s polling window.
+    app = (
+        ApplicationBuilder()
+        .token(config.bot_token)
+        .get_updates_read_timeout(30)
+        .get_updates_connect_timeout(20)
+        .get_updates_pool_timeout(30)
+        .persistence(persistence)
+        # Throttles every outbound API call just under Telegram's 30 msg/s and 20 msg/min-per-group
+        # limits (and per chat), retrying on RetryAfter. The headroom covers the webhook server's
+        # notifications, which are sent outside this limiter.
+        .rate_limiter(PerChatRateLimiter(
+            overall_max_rate=28, overall_time_period=1,
+            group_max_rate=18, group_time_period=60,
+            max_retries=3,
+        ))
+        # Process updates concurrently so one user's Stripe/DB wait doesn't stall everyone else.
+        .concurrent_updates(int(os.getenv("CONCURRENT_UPDATES", "50")))
+        .post_shutdown(_close_http)
+        .build()
+    )
+    app.bot_data["config"] = config
+    app.bot_data["services"] = Services(stripe_secret=config.stripe_secret)
+    app.bot_data["user_cache"] = USER_CACHE
+    # Handlers that actually run at once. Kept below CONCURRENT_UPDATES (which only caps how many
+    # updates PTB has in flight) and near the DB pool (20 + 10 overflow) so a burst queues here
+    # rather than on pool checkout, where waiters time out after 30s.
+    app.bot_data["sem"] = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENCY", "40")))
 
-    app = ApplicationBuilder().token(bot_token).build()
-    app.bot_data["stripe"] = stripe
+    # Plain text that isn't a command; one filter instance shared by every conversation state.
+    text_input = filters.TEXT & ~filters.COMMAND
 
     # --- A better fallback list for conversations ---
     smarter_fallbacks = [
-        CommandHandler("cancel", cancel_conversation),
-        MessageHandler(filters.COMMAND, invalid_conversation_state), # Ignore other commands
-        CallbackQueryHandler(invalid_conversation_state), # Ignore other buttons
+        CommandHandler("cancel", bounded(cancel_conversation)),
+        MessageHandler(filters.COMMAND, bounded(invalid_conversation_state)), # Ignore other commands
+        CallbackQueryHandler(bounded(invalid_conversation_state)), # Ignore other buttons
     ]
 
     # --- Conversation Handlers with updated fallbacks ---
+    # Named + persistent conversations are keyed by (chat_id, user_id); idle ones expire after 10 minutes.
     trade_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(main_menu_handler, pattern='^start_trade$')],
+        entry_points=[CallbackQueryHandler(bounded(main_menu_handler), pattern=PAT_TRADE)],
         states={
-            ASK_COUNTERPARTY: [MessageHandler(filters.REPLY, trade_ask_counterparty)],
-            ASK_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, trade_ask_description)],
-            ASK_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, trade_ask_amount)],
+            ASK_COUNTERPARTY: [MessageHandler(filters.REPLY, bounded(trade_ask_counterparty))],
+            ASK_DESCRIPTION: [MessageHandler(text_input, bounded(trade_ask_description))],
+            ASK_AMOUNT: [MessageHandler(text_input, bounded(trade_ask_amount))],
         },
         fallbacks=smarter_fallbacks,
-        per_message=False
+        per_message=False,
+        name="trade",
+        persistent=True,
+        conversation_timeout=600,
     )
 
     milestone_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(main_menu_handler, pattern='^start_milestone_project$')],
+        entry_points=[CallbackQueryHandler(bounded(main_menu_handler), pattern=PAT_MILESTONE)],
         states={
-            ASK_MILESTONE_COUNTERPARTY: [MessageHandler(filters.REPLY, milestone_ask_counterparty)],
-            ASK_MILESTONE_TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, milestone_ask_title)],
+            ASK_MILESTONE_COUNTERPARTY: [MessageHandler(filters.REPLY, bounded(milestone_ask_counterparty))],
+            ASK_MILESTONE_TITLE: [MessageHandler(text_input, bounded(milestone_ask_title))],
             ASK_MILESTONES_LOOP: [
-                CommandHandler("done", milestone_finish),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, milestone_ask_loop)
+                CommandHandler("done", bounded(milestone_finish)),
+                MessageHandler(text_input, bounded(milestone_ask_loop))
             ],
         },
         fallbacks=smarter_fallbacks,
-        per_message=False
+        per_message=False,
+        name="milestone",
+        persistent=True,
+        conversation_timeout=600,
     )
 
     dispute_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(dispute_start, pattern='^dispute_deal:')],
+        entry_points=[CallbackQueryHandler(bounded(dispute_start), pattern=PAT_DISPUTE)],
         states={
-            ASK_DISPUTE_REASON: [MessageHandler(filters.TEXT & ~filters.COMMAND, dispute_ask_reason)],
-            ASK_DISPUTE_PROOF: [MessageHandler(filters.PHOTO, dispute_process_proof)],
+            ASK_DISPUTE_REASON: [MessageHandler(text_input, bounded(dispute_ask_reason))],
+            ASK_DISPUTE_PROOF: [MessageHandler(filters.PHOTO, bounded(dispute_process_proof))],
         },
         fallbacks=smarter_fallbacks,
-        per_message=False
+        per_message=False,
+        name="dispute",
+        persistent=True,
+        conversation_timeout=600,
     )
 
+    # Admin commands share one composed filter: listed admins, in a private chat only.
+    admin_only = admin_filter & filters.ChatType.PRIVATE
+
     # --- Register all handlers in a specific order ---
-    # The ConversationHandlers must be registered first so they can handle their specific entry points.
-    app.add_handler(trade_conv)
-    app.add_handler(milestone_conv)
-    app.add_handler(dispute_conv)
-
-    # Standalone commands are next.
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("profile", profile))
-    app.add_handler(CommandHandler("connect", connect_stripe))
-
-    # Admin commands
-    app.add_handler(CommandHandler("admin_verify", admin_verify, filters=admin_filter))
-    app.add_handler(CommandHandler("admin_split", admin_split_funds, filters=admin_filter))
-
-    # Specific callback handlers
-    app.add_handler(CallbackQueryHandler(rating_handler, pattern='^rate:|^skip_rating:'))
-    
-    # The general button_handler is registered LAST. It will catch any button press
-    # that was NOT handled by one of the more specific handlers above (like the conversation entry points).
-    app.add_handler(CallbackQueryHandler(button_handler))
-
-    return app
\ No newline at end of file
+    # Within a group the first matching handler wins, so the order of this table is the priority:
+    # the ConversationHandlers first so they can handle their specific entry points, then
+    # standalone commands, and the callback dispatcher LAST. It catches any button press that was
+    # NOT handled by a conversation entry point above and routes it by callback-data prefix.
+    app.add_handlers({
+        0: [
+            trade_conv,
+            milestone_conv,
+            dispute_conv,
+            CommandHandler("start", bounded(start)),
+            CommandHandler("profile", bounded(profile)),
+            CommandHandler("connect", bounded(connect_stripe)),
+            CommandHandler("admin_verify", bounded(admin_verify), filters=admin_only),
+            CommandHandler("admin_split", bounded(admin_split_funds), filters=admin_only),
+            CallbackQueryHandler(bounded(dispatch_callback)),
+        ],
+    })
+
+    # Offer expiry and auto-release are stored on the deals and swept once a minute.
+    if app.job_queue is not None:
+        start_sweeper(app.job_queue)
+    else:
+        logging.getLogger(__name__).warning("JobQueue unavailable (install python-telegram-bot[job-queue]); timed deal actions won't run.")
+
+    return app
+
+def run_app(app):
+    """
+    Starts the bot. If WEBHOOK_URL is set, Telegram pushes updates to us;
+    otherwise we fall back to long polling with the maximum timeout Telegram accepts.
+    """
+    webhook_url = os.getenv("WEBHOOK_URL")
+    # Skip updates queued while the bot was down instead of replaying the backlog first.
+    drop_pending = os.getenv("DROP_PENDING", "1") == "1"
+    if webhook_url:
+        bot_token = app.bot.token
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("WEBHOOK_PORT", "8443")),
+            url_path=bot_token,
+            webhook_url=f"{webhook_url.rstrip('/')}/{bot_token}",
+            secret_token=os.getenv("WEBHOOK_SECRET_TOKEN"),
+            drop_pending_updates=drop_pending,
+        )
+    else:
+        app.run_polling(timeout=30, poll_interval=0, drop_pending_updates=drop_pending)
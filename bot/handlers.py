@@ -1,19 +1,32 @@
 import os
+import asyncio
+import functools
 import logging
 import re
-from datetime import datetime, timedelta
+from html import escape
+from typing import TYPE_CHECKING
+from datetime import timedelta
+from decimal import Decimal
 from telegram import Update
-from telegram.ext import (
-    ContextTypes, CommandHandler, ConversationHandler, MessageHandler,
-    CallbackQueryHandler, filters
-)
-from sqlalchemy.exc import NoResultFound
-from sqlalchemy import func, desc
+from telegram.ext import ContextTypes, ConversationHandler, filters
+from cachetools import TTLCache
+from sqlalchemy import func, desc, exists, insert, or_, select, true
+# Aliased: handlers take the Telegram Update as a parameter named `update`.
+from sqlalchemy import update as sql_update
+from sqlalchemy.orm import joinedload, selectinload
 
 from database.database import DB
 from database.models import User, Deal, Milestone, Review, Referral, Dispute
-from stripe_utils.stripe_utils import StripeHelper
-from .keyboards import *
+from utils.money import to_cents
+
+if TYPE_CHECKING:
+    from stripe_utils.stripe_utils import StripeHelper
+
+from .keyboards import (
+    MAIN_MENU_MARKUP, trade_confirmation_keyboard, trade_invite_keyboard,
+    trade_in_progress_keyboard, milestone_project_keyboard, rating_keyboard,
+    checkout_keyboard, onboarding_keyboard, STARS,
+)
 from scheduler import schedule_job, remove_job
 
 log = logging.getLogger(__name__)
@@ -26,67 +39,256 @@ ASK_DISPUTE_REASON, ASK_DISPUTE_PROOF = range(3, 5)
 # Milestone Creation
 ASK_MILESTONE_COUNTERPARTY, ASK_MILESTONE_TITLE, ASK_MILESTONES_LOOP = range(5, 8)
 
+# "Milestone Name: Amount", compiled once for milestone_ask_loop.
+_MILESTONE_RE = re.compile(r'^(.*?):\s*(\d+(?:\.\d{1,2})?)$')
+
+# A dollar amount with at most two decimals, e.g. "25", "19.99" or "$5.5".
+_MONEY_RE = re.compile(r'^\$?(\d+(?:\.\d{1,2})?)$')
+
+# /start deep-link payload "ref_<referrer telegram id>".
+_REFERRAL_RE = re.compile(r'^ref_(\d+)$')
+
+# Telegram id -> (users.id, username last stored). Never an ORM instance, which is tied to its
+# session. Every handler has a fresh session, so a returning user still costs one SELECT, by
+# primary key instead of through the telegram_id index; the real saving is that callers which
+# only need the id (trade creation, disputes) skip the users table entirely on a hit.
+_USER_PKS = TTLCache(maxsize=10_000, ttl=300)
+
 # --- Admin Filter ---
+# ADMIN_CHAT_ID receives dispute alerts; ADMIN_IDS can list further admins (comma-separated).
 try:
     ADMIN_ID = int(os.getenv("ADMIN_CHAT_ID"))
-    admin_filter = filters.User(user_id=ADMIN_ID)
 except (ValueError, TypeError):
+    ADMIN_ID = None
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip())
+if ADMIN_ID is not None:
+    ADMIN_IDS |= {ADMIN_ID}
+if not ADMIN_IDS:
     log.warning("ADMIN_CHAT_ID is not set. Admin commands will not be available.")
-    admin_filter = filters.User(user_id=0)
+# Built once at import; filters.User checks membership in a set per update.
+admin_filter = filters.User(user_id=ADMIN_IDS)
+
+# --- Loader Options ---
+# Handlers read both parties of almost every deal they touch; load them in the same
+# query instead of one lazy SELECT per attribute access.
+_DEAL_WITH_PARTIES = (joinedload(Deal.creator), joinedload(Deal.counterparty))
+_DEAL_DASHBOARD = _DEAL_WITH_PARTIES + (selectinload(Deal.milestones),)
+_MILESTONE_FULL = (joinedload(Milestone.deal).options(*_DEAL_DASHBOARD),)
 
 # --- Helper Functions ---
+def with_session(handler):
+    """
+    Opens a DB session for the handler, passed as its third argument, and
+    closes it however the handler exits (return, early return or exception).
+
+    Handler sessions don't expire on commit: every handler commits and then keeps
+    reading the same rows to build its replies, and re-SELECTing each one would
+    hold the event loop for another blocking round trip.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with DB.session_scope(expire_on_commit=False) as session:
+            return await handler(update, context, session)
+    return wrapper
+
+def _parse_money(text: str):
+    """
+    Returns text as a Decimal dollar amount, or None if it isn't one. Unlike float(), this
+    rejects "nan", "inf", exponents and sub-cent precision, and never rounds.
+    """
+    match = _MONEY_RE.match(text.strip())
+    return Decimal(match.group(1)) if match else None
+
+def _username_changed(user: User, tg_user) -> bool:
+    """
+    True if tg_user carries a new username for user. A missing username (None) never
+    overwrites a stored one, so the row isn't rewritten back and forth.
+    """
+    return tg_user.username is not None and user.username != tg_user.username
+
 def _get_or_create_user(session, tg_user):
-    try:
-        user = session.query(User).filter_by(telegram_id=tg_user.id).one()
-        if user.username != tg_user.username:
-            user.username = tg_user.username
-            session.commit()
+    """
+    Returns the User row for tg_user, creating it or refreshing its username as needed.
+    Only flushes (so a new row has its id); the calling handler commits once with its own changes.
+    """
+    user = None
+    cached = _USER_PKS.get(tg_user.id)
+    if cached is not None:
+        user = session.get(User, cached[0])
+        # The row may have been deleted (e.g. from the admin dashboard) since it was cached.
+        if user is None or user.telegram_id != tg_user.id:
+            user = None
+    if user is None:
+        user = session.scalars(select(User).where(User.telegram_id == tg_user.id)).one_or_none()
+    if user is None:
+        # Not cached until a later lookup finds it: this row only exists once the caller commits.
+        user = User(telegram_id=tg_user.id, username=tg_user.username)
+        session.add(user)
+        session.flush()
         return user
-    except NoResultFound:
-        u = User(telegram_id=tg_user.id, username=tg_user.username)
-        session.add(u)
-        session.commit()
-        return u
+    if _username_changed(user, tg_user):
+        user.username = tg_user.username
+    _USER_PKS[tg_user.id] = (user.id, user.username)
+    return user
+
+def _get_or_create_users(session, tg_users) -> dict:
+    """
+    Batch version of _get_or_create_user: one SELECT for all of tg_users, and
+    likewise no commit. Returns a dict of User rows keyed by Telegram id.
+    """
+    # The same user can be passed twice (e.g. a self-trade); look up and create each one once.
+    tg_users = list({tg_user.id: tg_user for tg_user in tg_users}.values())
+    found = {
+        u.telegram_id: u
+        for u in session.scalars(select(User).where(User.telegram_id.in_([t.id for t in tg_users])))
+    }
+    users = dict(found)
+    created = False
+    for tg_user in tg_users:
+        user = users.get(tg_user.id)
+        if user is None:
+            users[tg_user.id] = User(telegram_id=tg_user.id, username=tg_user.username)
+            session.add(users[tg_user.id])
+            created = True
+        elif _username_changed(user, tg_user):
+            user.username = tg_user.username
+    if created:
+        session.flush()
+    # As in _get_or_create_user, only rows that already existed are cached: new ones only
+    # exist once the caller commits.
+    for tg_id, user in found.items():
+        _USER_PKS[tg_id] = (user.id, user.username)
+    return users
+
+def _get_or_create_user_ids(session, tg_users) -> dict:
+    """
+    Like _get_or_create_users, but returns users.id keyed by Telegram id, for callers that
+    only need the keys. Users cached with an unchanged username cost no SQL at all; the
+    rest go through one _get_or_create_users call.
+    """
+    ids, misses = {}, []
+    for tg_user in tg_users:
+        cached = _USER_PKS.get(tg_user.id)
+        if cached is not None and tg_user.username in (None, cached[1]):
+            ids[tg_user.id] = cached[0]
+        else:
+            misses.append(tg_user)
+    if misses:
+        ids.update((tg_id, user.id) for tg_id, user in _get_or_create_users(session, misses).items())
+    return ids
+
+def _username_is(username: str):
+    """
+    Case-insensitive exact match on username, served by ix_users_username_lower.
+    Not ILIKE: that can't use a plain index and treats '_' in usernames as a wildcard.
+    """
+    return func.lower(User.username) == username.lower()
+
+def _find_user_by_username(session, username: str):
+    return session.scalar(select(User).where(_username_is(username)).limit(1))
+
+def _complete_deal(deal: Deal):
+    """Marks a deal completed and bumps both parties' completed_deals_count once."""
+    if deal.status == "completed":
+        return
+    deal.status = "completed"
+    for party in (deal.creator, deal.counterparty):
+        party.completed_deals_count = (party.completed_deals_count or 0) + 1
+
+def _invalidate_user_cache(context: ContextTypes.DEFAULT_TYPE, *user_ids: int):
+    """Drops cached profile data for users whose stats just changed."""
+    cache = context.bot_data.get("user_cache")
+    if cache is not None:
+        for user_id in user_ids:
+            cache.pop(user_id, None)
+
+async def _send_all(*coros):
+    """
+    Awaits independent Telegram calls concurrently instead of one round trip after another.
+    A failed send is logged and doesn't cancel the others. The calls can land in any order,
+    so messages to the same chat that must be read in sequence belong in separate waves.
+    Throttling is left to the application's rate limiter, which every context.bot call goes through.
+    """
+    for result in await asyncio.gather(*coros, return_exceptions=True):
+        if isinstance(result, Exception):
+            log.warning("Telegram notification failed: %s", result)
+
+def _in_background(context: ContextTypes.DEFAULT_TYPE, *coros):
+    """
+    Schedules notifications the user's own reply shouldn't wait on, such as the admin's
+    dispute alert. They go through _send_all, so a failure is still logged.
+    """
+    context.application.create_task(_send_all(*coros))
+
+# Telegram rejects messages over 4096 characters and photo captions over 1024.
+MESSAGE_LIMIT = 4000
+CAPTION_LIMIT = 1024
+
+def _chunk_text(text: str, limit: int = MESSAGE_LIMIT) -> list:
+    """Splits text into pieces of at most limit characters, preferring to break at a newline."""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    chunks.append(text)
+    return chunks
+
+async def _send_long(bot, chat_id: int, text: str, **kwargs):
+    """
+    Sends text to one chat, split with _chunk_text; chunks go out in order. The split ignores
+    markup, so don't pass parse_mode for text that could be cut inside a tag or an entity.
+    """
+    for chunk in _chunk_text(text):
+        await bot.send_message(chat_id=chat_id, text=chunk, **kwargs)
 
 async def _prompt_for_ratings(context: ContextTypes.DEFAULT_TYPE, deal: Deal):
-    """Sends rating prompts to both parties of a completed deal."""
+    """
+    Sends rating prompts to both parties of a completed deal.
+    Callers pass a deal loaded with _DEAL_WITH_PARTIES so this issues no SQL.
+    """
     buyer_text = f"Deal complete! Please rate your experience with the seller, @{deal.creator.username}."
-    await context.bot.send_message(
-        chat_id=deal.counterparty.telegram_id,
-        text=buyer_text,
-        reply_markup=rating_keyboard(deal.id, deal.creator.id)
-    )
     seller_text = f"Deal complete! Please rate your experience with the buyer, @{deal.counterparty.username}."
-    await context.bot.send_message(
-        chat_id=deal.creator.telegram_id,
-        text=seller_text,
-        reply_markup=rating_keyboard(deal.id, deal.counterparty.id)
+    await _send_all(
+        context.bot.send_message(
+            chat_id=deal.counterparty.telegram_id,
+            text=buyer_text,
+            reply_markup=rating_keyboard(deal.id, deal.creator.id)
+        ),
+        context.bot.send_message(
+            chat_id=deal.creator.telegram_id,
+            text=seller_text,
+            reply_markup=rating_keyboard(deal.id, deal.counterparty.id)
+        ),
     )
 
 # --- Main Command & Menu Handlers ---
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_session
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     """Sends the main menu and handles referral links."""
-    session = DB.session()
     new_user = _get_or_create_user(session, update.effective_user)
-    
-    if context.args and context.args[0].startswith('ref_'):
-        try:
-            referrer_id = int(context.args[0].split('_')[1])
-            if referrer_id != new_user.telegram_id and not new_user.referral_received:
-                referrer = session.query(User).filter_by(telegram_id=referrer_id).first()
-                if referrer:
-                    referral = Referral(referrer_id=referrer.id, referred_user_id=new_user.id)
-                    session.add(referral)
-                    session.commit()
-                    await update.message.reply_text(f"Welcome! You were referred by @{referrer.username}.")
-        except (ValueError, IndexError):
-            pass
+    referrer = None
+
+    match = _REFERRAL_RE.match(context.args[0]) if context.args else None
+    if match:
+        referrer_id = int(match.group(1))
+        already_referred = session.scalar(select(exists().where(Referral.referred_user_id == new_user.id)))
+        if referrer_id != new_user.telegram_id and not already_referred:
+            referrer = session.scalar(select(User).where(User.telegram_id == referrer_id))
+            if referrer:
+                session.add(Referral(referrer_id=referrer.id, referred_user_id=new_user.id))
+    # One commit for the user row and any referral.
+    session.commit()
+
+    if referrer:
+        await update.message.reply_text(f"Welcome! You were referred by @{referrer.username}.")
 
     await update.message.reply_text(
         "Welcome to the Secure Escrow Bot! What would you like to do?",
-        reply_markup=main_menu_keyboard()
+        reply_markup=MAIN_MENU_MARKUP
     )
-    session.close()
 
 async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -118,21 +320,19 @@ async def trade_ask_description(update: Update, context: ContextTypes.DEFAULT_TY
     await update.message.reply_text("What is the amount in USD to hold in escrow?")
     return ASK_AMOUNT
 
-async def trade_ask_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        amount = float(update.message.text)
-        if amount <= 0: raise ValueError("Amount must be positive")
-    except ValueError:
-        await update.message.reply_text("Please enter a valid, positive number.")
+@with_session
+async def trade_ask_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    amount = _parse_money(update.message.text)
+    if amount is None or amount <= 0:
+        await update.message.reply_text("Please enter a valid, positive amount (e.g. 25 or 19.99).")
         return ASK_AMOUNT
 
-    session = DB.session()
-    seller = _get_or_create_user(session, update.effective_user)
-    buyer = _get_or_create_user(session, context.user_data['counterparty_tg'])
+    seller_tg, buyer_tg = update.effective_user, context.user_data['counterparty_tg']
+    user_ids = _get_or_create_user_ids(session, [seller_tg, buyer_tg])
 
     deal = Deal(
-        creator_id=seller.id,
-        counterparty_id=buyer.id,
+        creator_id=user_ids[seller_tg.id],
+        counterparty_id=user_ids[buyer_tg.id],
         title=context.user_data['description'],
         total_amount=amount,
         deal_type='trade',
@@ -142,19 +342,18 @@ async def trade_ask_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session.commit()
 
     summary_text = (
-        f"**Trade Offer Summary:**\n\n"
-        f"**Item:** {deal.title}\n"
-        f"**Amount:** ${deal.total_amount:.2f} USD\n"
-        f"**Seller:** @{seller.username}\n"
-        f"**Buyer:** @{buyer.username}\n\n"
+        f"<b>Trade Offer Summary:</b>\n\n"
+        f"<b>Item:</b> {escape(deal.title)}\n"
+        f"<b>Amount:</b> ${deal.total_amount:.2f} USD\n"
+        f"<b>Seller:</b> @{escape(seller_tg.username or '')}\n"
+        f"<b>Buyer:</b> @{escape(buyer_tg.username or '')}\n\n"
         f"Please confirm to send this offer to the buyer."
     )
     await update.message.reply_text(
         summary_text,
-        reply_markup=trade_confirmation_keyboard(deal.id),
-        parse_mode='Markdown'
+        reply_markup=trade_confirmation_keyboard(deal.id, seller_tg.id),
+        parse_mode='HTML'
     )
-    session.close()
     return ConversationHandler.END
 
 # --- Milestone Project Conversation ---
@@ -177,35 +376,37 @@ async def milestone_ask_title(update: Update, context: ContextTypes.DEFAULT_TYPE
     return ASK_MILESTONES_LOOP
 
 async def milestone_ask_loop(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip()
-    match = re.match(r'^(.*?):\s*(\d+(\.\d{1,2})?)$', text)
-    
-    if not match:
-        await update.message.reply_text("Invalid format. Please use `Name: Amount` (e.g., `Initial Mockups: 200`).")
+    match = _MILESTONE_RE.match(update.message.text.strip())
+    name, amount = (match.group(1).strip(), Decimal(match.group(2))) if match else ("", 0)
+
+    if not name or amount <= 0:
+        await update.message.reply_text(
+            "Invalid format. Please use <code>Name: Amount</code> with a positive amount (e.g., <code>Initial Mockups: 200</code>).",
+            parse_mode='HTML',
+        )
         return ASK_MILESTONES_LOOP
 
-    name, amount_str = match.groups()[:2]
-    amount = float(amount_str)
-    context.user_data["milestones"].append({"name": name.strip(), "amount": amount})
+    context.user_data["milestones"].append({"name": name, "amount": amount})
     
     total_milestones = len(context.user_data["milestones"])
     total_amount = sum(m['amount'] for m in context.user_data["milestones"])
     
     await update.message.reply_text(
-        f"Milestone '{name.strip()}' for ${amount:.2f} added.\n"
+        f"Milestone '{name}' for ${amount:.2f} added.\n"
         f"You now have {total_milestones} milestone(s) totalling ${total_amount:.2f}.\n\n"
         "Add another milestone, or use /done to finalize the project."
     )
     return ASK_MILESTONES_LOOP
 
-async def milestone_finish(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_session
+async def milestone_finish(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     if not context.user_data.get("milestones"):
         await update.message.reply_text("You haven't added any milestones. Please add at least one or use /cancel.")
         return ASK_MILESTONES_LOOP
 
-    session = DB.session()
-    client = _get_or_create_user(session, update.effective_user)
-    contractor = _get_or_create_user(session, context.user_data['counterparty_tg'])
+    client_tg, contractor_tg = update.effective_user, context.user_data['counterparty_tg']
+    users = _get_or_create_users(session, [client_tg, contractor_tg])
+    client, contractor = users[client_tg.id], users[contractor_tg.id]
 
     deal = Deal(
         creator_id=client.id,
@@ -217,26 +418,28 @@ async def milestone_finish(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session.add(deal)
     session.flush()
 
-    for ms_data in context.user_data["milestones"]:
-        ms = Milestone(deal_id=deal.id, name=ms_data['name'], amount=ms_data['amount'])
-        session.add(ms)
-    
+    # One multi-row INSERT for all milestones instead of an ORM insert per row.
+    session.execute(insert(Milestone), [
+        {"deal_id": deal.id, "name": ms_data['name'], "amount": ms_data['amount']}
+        for ms_data in context.user_data["milestones"]
+    ])
     session.commit()
 
     text, keyboard = milestone_project_keyboard(deal)
-    await update.message.reply_text(text, reply_markup=keyboard, parse_mode='Markdown')
+    await update.message.reply_text(text, reply_markup=keyboard, parse_mode='HTML')
     
     context.user_data.clear()
-    session.close()
     return ConversationHandler.END
 
 # --- Dispute Conversation ---
 async def dispute_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    action, deal_id_str = query.data.split(":")
+    _, _, deal_id_str = query.data.partition(":")
     context.user_data['dispute_deal_id'] = int(deal_id_str)
-    await query.answer()
-    await query.message.reply_text("You have started the dispute process. Please describe the issue in a single message.")
+    await _send_all(
+        query.answer(),
+        query.message.reply_text("You have started the dispute process. Please describe the issue in a single message."),
+    )
     return ASK_DISPUTE_REASON
 
 async def dispute_ask_reason(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -244,40 +447,62 @@ async def dispute_ask_reason(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text("Thank you. Now, please upload a single photo as proof (e.g., a screenshot of the item not working, or incorrect item).")
     return ASK_DISPUTE_PROOF
 
-async def dispute_process_proof(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    session = DB.session()
+@with_session
+async def dispute_process_proof(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     deal_id = context.user_data['dispute_deal_id']
-    deal = session.get(Deal, deal_id)
-    
-    if deal.auto_job_id:
-        remove_job(context.job_queue, deal.auto_job_id)
+    reason = context.user_data['dispute_reason']
+    # Bound once: used for both the DB row and the admin alert.
+    proof_id = update.message.photo[-1].file_id
+    reporter_username = update.effective_user.username
+    # users.id, not the Telegram id: the deal's party columns and raised_by_id refer to users.
+    reporter_id = _get_or_create_user_ids(session, [update.effective_user])[update.effective_user.id]
+    # One Core UPDATE (no Deal object is built); it also cancels any pending timed action.
+    # It only matches a deal the reporter is a party to.
+    disputed = session.execute(
+        sql_update(Deal)
+        .where(Deal.id == deal_id, or_(Deal.creator_id == reporter_id, Deal.counterparty_id == reporter_id))
+        .values(
+            status='disputed', admin_notes=f"Dispute raised by @{reporter_username}.",
+            auto_job_id=None, auto_job_at=None,
+        )
+    ).rowcount
+    if not disputed:
+        session.commit()  # Keeps the reporter's user row if it was just created.
+        await update.message.reply_text("You can only raise a dispute on a deal you are part of.")
+        context.user_data.clear()
+        return ConversationHandler.END
 
-    deal.status = 'disputed'
-    deal.admin_notes = f"Dispute raised by @{update.effective_user.username}."
-    
     dispute = Dispute(
-        deal_id=deal.id,
-        raised_by_id=update.effective_user.id,
-        reason=context.user_data['dispute_reason'],
-        proof_file_id=update.message.photo[-1].file_id
+        deal_id=deal_id,
+        raised_by_id=reporter_id,
+        reason=reason,
+        proof_file_id=proof_id
     )
     session.add(dispute)
     session.commit()
 
+    if ADMIN_ID is not None:
+        _in_background(context, _send_dispute_alert(context.bot, deal_id, proof_id, reporter_username, reason))
     await update.message.reply_text("✅ Dispute submitted. An admin has been notified and will review your case shortly. All actions on this deal are now locked.")
 
-    admin_text = (
-        f"‼️ **DISPUTE ALERT: Deal #{deal.id}** ‼️\n\n"
-        f"**User:** @{update.effective_user.username}\n"
-        f"**Reason:** {dispute.reason}\n\n"
-        f"Proof is attached. Use admin commands to resolve."
-    )
-    await context.bot.send_photo(chat_id=ADMIN_ID, photo=dispute.proof_file_id, caption=admin_text)
-    
     context.user_data.clear()
-    session.close()
     return ConversationHandler.END
 
+async def _send_dispute_alert(bot, deal_id: int, proof_id: str, reporter_username: str, reason: str):
+    header = (
+        f"‼️ <b>DISPUTE ALERT: Deal #{deal_id}</b> ‼️\n\n"
+        f"<b>User:</b> @{escape(reporter_username or '')}\n"
+    )
+    admin_text = header + f"<b>Reason:</b> {escape(reason)}\n\nProof is attached. Use admin commands to resolve."
+    if len(admin_text) <= CAPTION_LIMIT:
+        await bot.send_photo(chat_id=ADMIN_ID, photo=proof_id, caption=admin_text, parse_mode='HTML')
+    else:
+        # A long reason doesn't fit in a caption: attach the proof, then the alert as text. The
+        # reason goes out as plain text, so splitting it can't cut through an entity or a tag.
+        await bot.send_photo(chat_id=ADMIN_ID, photo=proof_id, caption=f"Proof for Deal #{deal_id} dispute.")
+        await bot.send_message(chat_id=ADMIN_ID, text=header + "Proof is attached. Use admin commands to resolve. The reason follows.", parse_mode='HTML')
+        await _send_long(bot, ADMIN_ID, f"Reason: {reason}")
+
 # --- Graceful Conversation Fallbacks ---
 async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ends a conversation gracefully."""
@@ -289,292 +514,511 @@ async def invalid_conversation_state(update: Update, context: ContextTypes.DEFAU
     await update.message.reply_text("Invalid input. Please follow the prompts or type /cancel to exit.")
     return None
 
+# Deal statuses in which escrowed funds must not be released: a dispute holds them for the
+# admin, and a completed or cancelled deal has already paid out or refunded.
+_RELEASE_LOCKED = ("disputed", "completed", "cancelled")
+
+# --- Trade Actions ---
+# Each takes the callback query, the context, the open session, the deal (both parties
+# loaded) and the Telegram id of the user who pressed the button, and answers the query:
+# with an alert if that user may not use the button, otherwise plainly before acting.
+async def _send_offer(query, context: ContextTypes.DEFAULT_TYPE, session, deal: Deal, user_tg_id: int):
+    if user_tg_id != deal.creator.telegram_id:
+        await query.answer("Only the seller can send the offer.", show_alert=True)
+        return
+    await query.answer()
+    cp_tg_id = deal.counterparty.telegram_id
+    schedule_job(deal, "expire_offer", timedelta(hours=24))
+    session.commit()
+    invite_text = f"You've been invited to a secure trade by @{escape(deal.creator.username or '')}!\n\n<b>Item:</b> {escape(deal.title)}\n<b>Price:</b> ${deal.total_amount:.2f} USD"
+    # Sequential on purpose: the seller is only told the offer went out once it has.
+    await context.bot.send_message(chat_id=cp_tg_id, text=invite_text, reply_markup=trade_invite_keyboard(deal.id, cp_tg_id), parse_mode='HTML')
+    await query.edit_message_text("✅ Offer sent to the buyer!")
+
+async def _pay_trade(query, context: ContextTypes.DEFAULT_TYPE, session, deal: Deal, user_tg_id: int):
+    if user_tg_id != deal.counterparty.telegram_id:
+        await query.answer("Only the buyer can pay for this trade.", show_alert=True)
+        return
+    await query.answer()
+    stripe: StripeHelper = context.bot_data["services"].stripe
+    config = context.bot_data["config"]
+    buyer = deal.counterparty
+    application_fee_cents = 0
+    meta = None
+    if not buyer.completed_deals_count: pass
+    # Only flagged here: the webhook spends the free trade once the checkout is actually paid.
+    elif buyer.free_trades_remaining > 0: meta = {"deal_id": str(deal.id), "free_trade": "1"}
+    elif config.platform_fee_ratio > 0: application_fee_cents = to_cents(deal.total_amount * config.platform_fee_ratio)
+    # End the transaction first so its pooled connection isn't held across the Stripe call.
+    session.commit()
+
+    checkout_url = await stripe.create_checkout_session(deal.id, deal.title, deal.total_amount, deal.currency, config.success_url, config.cancel_url, application_fee_cents, meta)
+    await query.message.reply_text("Click the button below to securely fund the escrow.", reply_markup=checkout_keyboard(checkout_url))
+
+async def _mark_shipped(query, context: ContextTypes.DEFAULT_TYPE, session, deal: Deal, user_tg_id: int):
+    if user_tg_id != deal.creator.telegram_id:
+        await query.answer("Only the seller can mark the item as shipped.", show_alert=True)
+        return
+    await query.answer()
+    cp_tg_id = deal.counterparty.telegram_id
+    deal.trade_status = "shipped"
+    schedule_job(deal, "check_unconfirmed_deliveries", timedelta(days=7))
+    session.commit()
+    shipped_text = f"🚚 <b>Item Shipped!</b>\n\n@{escape(deal.creator.username or '')} has marked the item '{escape(deal.title)}' as shipped. Buyer, please confirm delivery once you receive it."
+    await _send_all(
+        query.edit_message_text(shipped_text, reply_markup=trade_in_progress_keyboard(deal), parse_mode='HTML'),
+        context.bot.send_message(chat_id=cp_tg_id, text=shipped_text, parse_mode='HTML'),
+    )
+
+async def _confirm_delivery(query, context: ContextTypes.DEFAULT_TYPE, session, deal: Deal, user_tg_id: int):
+    if user_tg_id != deal.counterparty.telegram_id:
+        await query.answer("Only the buyer can confirm delivery.", show_alert=True)
+        return
+    await query.answer()
+    if not deal.creator.stripe_account_id:
+        await query.message.reply_text("Seller has not connected their Stripe account. They must run /connect.")
+        return
+    stripe: StripeHelper = context.bot_data["services"].stripe
+    creator_tg_id = deal.creator.telegram_id
+    # Claims the release: only one confirmation (or the auto-release) can move the trade out
+    # of 'shipped', so a stale or repeated button can't pay out again, nor one pressed after
+    # the deal was disputed or settled by an admin split.
+    claimed = session.execute(
+        sql_update(Deal)
+        .where(Deal.id == deal.id, Deal.trade_status == "shipped", Deal.status.notin_(_RELEASE_LOCKED))
+        .values(trade_status="releasing")
+    ).rowcount
+    # Commits the claim, and ends the transaction so its pooled connection isn't held
+    # across the Stripe call.
+    session.commit()
+    if not claimed:
+        await query.edit_message_text("This delivery has already been confirmed, or the trade has been settled.")
+        return
+    try:
+        await stripe.transfer(deal.total_amount, deal.currency, deal.creator.stripe_account_id, f"deal-{deal.id}", idempotency_key=f"deal-{deal.id}-release")
+    except Exception as e:
+        log.error("Release for deal %s failed: %s", deal.id, e)
+        _unclaim_release(session, deal)
+        await query.message.reply_text("⚠️ The payout to the seller failed, so the trade is still open. Please try again shortly.")
+        return
+    deal.trade_status = "completed"
+    # The auto-release is only cancelled now: until the payout succeeds it is the fallback.
+    remove_job(deal)
+    _complete_deal(deal)
+    session.commit()
+    _invalidate_user_cache(context, deal.creator_id, deal.counterparty_id)
+    completed_text = f"✅ <b>Trade Complete!</b>\n\nFunds for '{escape(deal.title)}' have been released to the seller. This trade is now complete."
+    await _send_all(
+        query.edit_message_text(completed_text, parse_mode='HTML'),
+        context.bot.send_message(chat_id=creator_tg_id, text=completed_text, parse_mode='HTML'),
+    )
+    # A second wave, so each party sees "complete" before the rating prompt in the same chat.
+    await _prompt_for_ratings(context, deal)
+
+def _unclaim_release(session, deal: Deal):
+    """Puts a trade whose payout failed back to 'shipped', so the release can be tried again."""
+    session.execute(
+        sql_update(Deal).where(Deal.id == deal.id, Deal.trade_status == "releasing").values(trade_status="shipped")
+    )
+    session.commit()
+
+async def _decline_trade(query, context: ContextTypes.DEFAULT_TYPE, session, deal: Deal, user_tg_id: int):
+    if user_tg_id != deal.counterparty.telegram_id:
+        await query.answer("Only the buyer can decline the trade.", show_alert=True)
+        return
+    await query.answer()
+    creator_tg_id = deal.creator.telegram_id
+    deal.status = "cancelled"
+    deal.admin_notes = "Offer declined by buyer."
+    session.commit()
+    _in_background(context, context.bot.send_message(chat_id=creator_tg_id, text=f"The trade offer for '{deal.title}' was declined by the buyer."))
+    await query.edit_message_text("You have declined the trade offer.")
+
+async def _cancel_deal(query, context: ContextTypes.DEFAULT_TYPE, session, deal: Deal, user_tg_id: int):
+    if user_tg_id != deal.creator.telegram_id:
+        await query.answer("Only the creator of the offer can cancel it before it's sent.", show_alert=True)
+        return
+    await query.answer()
+    deal.status = "cancelled"
+    deal.admin_notes = "Draft offer cancelled by creator."
+    session.commit()
+    await query.edit_message_text("Trade creation cancelled.")
+
+# --- Milestone Actions ---
+# Same arguments as the trade actions, but with the milestone (its deal and parties loaded).
+async def _deposit_milestone(query, context: ContextTypes.DEFAULT_TYPE, session, milestone: Milestone, user_tg_id: int):
+    deal = milestone.deal
+    if user_tg_id != deal.creator.telegram_id:
+        await query.answer("Only the client can deposit funds.", show_alert=True)
+        return
+    await query.answer()
+    stripe: StripeHelper = context.bot_data["services"].stripe
+    config = context.bot_data["config"]
+    meta = {"milestone_id": str(milestone.id), "deal_id": str(deal.id)}
+    # End the transaction first so its pooled connection isn't held across the Stripe call.
+    session.commit()
+    checkout_url = await stripe.create_checkout_session(deal.id, deal.title, milestone.amount, deal.currency, config.success_url, config.cancel_url, 0, meta)
+    await query.message.reply_text("Click below to fund the milestone:", reply_markup=checkout_keyboard(checkout_url))
+
+async def _release_milestone(query, context: ContextTypes.DEFAULT_TYPE, session, milestone: Milestone, user_tg_id: int):
+    deal = milestone.deal
+    if user_tg_id != deal.creator.telegram_id:
+        await query.answer("Only the client can release funds.", show_alert=True)
+        return
+    await query.answer()
+    if not deal.counterparty.stripe_account_id:
+        await query.message.reply_text("Contractor has not connected their Stripe account. They must run /connect.")
+        return
+    stripe: StripeHelper = context.bot_data["services"].stripe
+    # Claims the release, so a stale or repeated button can't pay the milestone out again.
+    claimed = session.execute(
+        sql_update(Milestone).where(Milestone.id == milestone.id, Milestone.is_released.is_(False)).values(is_released=True)
+    ).rowcount
+    # Commits the claim, and ends the transaction so its pooled connection isn't held across the Stripe call.
+    session.commit()
+    if not claimed:
+        await query.message.reply_text("This milestone has already been released.")
+        return
+    try:
+        milestone.transfer_id = await stripe.transfer(milestone.amount, deal.currency, deal.counterparty.stripe_account_id, f"deal-{deal.id}", idempotency_key=f"milestone-{milestone.id}-release")
+    except Exception as e:
+        log.error("Release of milestone %s failed: %s", milestone.id, e)
+        session.execute(sql_update(Milestone).where(Milestone.id == milestone.id).values(is_released=False))
+        session.commit()
+        await query.message.reply_text("⚠️ The payout to the contractor failed, so the milestone is still held. Please try again shortly.")
+        return
+    # deal.milestones is already loaded, and the claim above updated this milestone in it.
+    if all(m.is_released for m in deal.milestones):
+        _complete_deal(deal)
+        _invalidate_user_cache(context, deal.creator_id, deal.counterparty_id)
+    session.commit()
+    text, keyboard = milestone_project_keyboard(deal)
+    await query.edit_message_text(text, reply_markup=keyboard, parse_mode='HTML')
+
+_TRADE_ACTIONS = {
+    "send_offer": _send_offer,
+    "pay_trade": _pay_trade,
+    "mark_shipped": _mark_shipped,
+    "confirm_delivery": _confirm_delivery,
+    "decline_trade": _decline_trade,
+    "cancel_deal": _cancel_deal,
+}
+_MILESTONE_ACTIONS = {
+    "deposit_milestone": _deposit_milestone,
+    "release_milestone": _release_milestone,
+}
+
 # --- Unified Button Handler ---
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_session
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     """
     This is a powerful, unified handler for ALL non-conversation-starting buttons.
+    Actions on a deal or milestone are looked up in _TRADE_ACTIONS / _MILESTONE_ACTIONS.
     """
     query = update.callback_query
-    await query.answer()
-    
+    # Every path answers the query exactly once (Telegram rejects a second answer), so
+    # the refusals below can show their alert.
+
     # --- Handle simple menu actions first ---
     if query.data == "view_profile":
+        await query.answer()
         await query.message.delete()
         await profile(update, context)
         return
     
     if query.data == "connect_stripe":
+        await query.answer()
         await query.message.delete()
         await connect_stripe(update, context)
         return
 
     # --- Handle actions that have an ID, like deals and milestones ---
-    action, entity_id_str = query.data.split(":")
+    action, _, rest = query.data.partition(":")
+    entity_id_str, _, authorized = rest.partition(":")
     entity_id = int(entity_id_str)
+    user_tg_id = update.effective_user.id
+    # Buttons that name their allowed user are rejected here without touching the DB;
+    # the per-action checks below still apply (and cover older two-field buttons).
+    if authorized and int(authorized) != user_tg_id:
+        await query.answer("You are not authorized to use this button.", show_alert=True)
+        return
 
-    session = DB.session()
-    user = update.effective_user
-    stripe: StripeHelper = context.bot_data["stripe"]
-    base_url = os.environ["BASE_URL"]
-
-    # --- Trade-Specific Actions ---
-    if action in ["send_offer", "pay_trade", "mark_shipped", "confirm_delivery", "decline_trade", "cancel_deal"]:
-        deal = session.get(Deal, entity_id)
+    if (trade_action := _TRADE_ACTIONS.get(action)) is not None:
+        deal = session.get(Deal, entity_id, options=_DEAL_WITH_PARTIES)
         if not deal:
+            await query.answer()
             await query.edit_message_text("This trade was not found.")
-            session.close()
             return
+        if deal.status == "disputed":
+            await query.answer("This trade is in dispute. All actions are locked.", show_alert=True)
+            return
+        await trade_action(query, context, session, deal, user_tg_id)
 
-        if action == "send_offer":
-            if user.id != deal.creator.telegram_id:
-                await query.answer("Only the seller can send the offer.", show_alert=True)
-            else:
-                job_id = f"expire_offer_{deal.id}"
-                deal.auto_job_id = job_id
-                session.commit()
-                schedule_job(context.job_queue, job_id, deal.id, "expire_offer", datetime.now() + timedelta(hours=24))
-                invite_text = f"You've been invited to a secure trade by @{deal.creator.username}!\n\n**Item:** {deal.title}\n**Price:** ${deal.total_amount:.2f} USD"
-                await context.bot.send_message(chat_id=deal.counterparty.telegram_id, text=invite_text, reply_markup=trade_invite_keyboard(deal.id))
-                await query.edit_message_text("✅ Offer sent to the buyer!")
-
-        elif action == "pay_trade":
-            if user.id != deal.counterparty.telegram_id:
-                await query.answer("Only the buyer can pay for this trade.", show_alert=True)
-            else:
-                buyer = deal.counterparty
-                application_fee_cents = 0
-                platform_fee_percent = float(os.getenv("PLATFORM_FEE_PERCENT", "0"))
-                completed_deals_count = session.query(Deal).filter(((Deal.creator_id == buyer.id) | (Deal.counterparty_id == buyer.id)), Deal.status == 'completed').count()
-                if completed_deals_count == 0: pass 
-                elif buyer.free_trades_remaining > 0: buyer.free_trades_remaining -= 1
-                elif platform_fee_percent > 0: application_fee_cents = int((deal.total_amount * (platform_fee_percent / 100)) * 100)
-                
-                checkout_url = stripe.create_checkout_session(deal.id, deal.title, deal.total_amount, deal.currency, f"{base_url}/success.html", f"{base_url}/cancel.html", application_fee_cents)
-                await query.message.reply_text("Click the button below to securely fund the escrow.", reply_markup=checkout_keyboard(checkout_url))
-
-        elif action == "mark_shipped":
-            if user.id != deal.creator.telegram_id:
-                await query.answer("Only the seller can mark the item as shipped.", show_alert=True)
-            else:
-                deal.trade_status = "shipped"
-                job_id = f"auto_release_{deal.id}"
-                deal.auto_job_id = job_id
-                session.commit()
-                schedule_job(context.job_queue, job_id, deal.id, "check_unconfirmed_deliveries", datetime.now() + timedelta(days=7))
-                shipped_text = f"🚚 **Item Shipped!**\n\n@{deal.creator.username} has marked the item '{deal.title}' as shipped. Buyer, please confirm delivery once you receive it."
-                await query.edit_message_text(shipped_text, reply_markup=trade_in_progress_keyboard(deal))
-                await context.bot.send_message(chat_id=deal.counterparty.telegram_id, text=shipped_text)
-
-        elif action == "confirm_delivery":
-            if user.id != deal.counterparty.telegram_id:
-                await query.answer("Only the buyer can confirm delivery.", show_alert=True)
-            else:
-                if deal.auto_job_id: remove_job(context.job_queue, deal.auto_job_id)
-                stripe.transfer(deal.total_amount, deal.currency, deal.creator.stripe_account_id, f"deal-{deal.id}")
-                deal.trade_status = "completed"
-                deal.status = "completed"
-                session.commit()
-                completed_text = f"✅ **Trade Complete!**\n\nFunds for '{deal.title}' have been released to the seller. This trade is now complete."
-                await query.edit_message_text(completed_text)
-                await context.bot.send_message(chat_id=deal.creator.telegram_id, text=completed_text)
-                await _prompt_for_ratings(context, deal)
-
-        elif action == "decline_trade":
-            if user.id != deal.counterparty.telegram_id:
-                await query.answer("Only the buyer can decline the trade.", show_alert=True)
-            else:
-                deal.status = "cancelled"
-                deal.admin_notes = "Offer declined by buyer."
-                session.commit()
-                await query.edit_message_text("You have declined the trade offer.")
-                await context.bot.send_message(chat_id=deal.creator.telegram_id, text=f"The trade offer for '{deal.title}' was declined by the buyer.")
-        
-        elif action == "cancel_deal":
-            if user.id != deal.creator.telegram_id:
-                await query.answer("Only the creator of the offer can cancel it before it's sent.", show_alert=True)
-            else:
-                deal.status = "cancelled"
-                deal.admin_notes = "Draft offer cancelled by creator."
-                session.commit()
-                await query.edit_message_text("Trade creation cancelled.")
-
-    # --- Milestone-Specific Actions ---
-    elif action in ["deposit_milestone", "release_milestone"]:
-        milestone = session.get(Milestone, entity_id)
+    elif (milestone_action := _MILESTONE_ACTIONS.get(action)) is not None:
+        milestone = session.get(Milestone, entity_id, options=_MILESTONE_FULL)
         if not milestone:
+            await query.answer()
             await query.edit_message_text("This milestone could not be found.")
+        elif milestone.deal.status == "disputed":
+            await query.answer("This project is in dispute. All actions are locked.", show_alert=True)
         else:
-            deal = milestone.deal
-            if deal.status == "disputed":
-                await query.answer("This project is in dispute. All actions are locked.", show_alert=True)
-            elif action == "deposit_milestone":
-                if user.id != deal.creator.telegram_id:
-                    await query.answer("Only the client can deposit funds.", show_alert=True)
-                else:
-                    meta = {"milestone_id": str(milestone.id), "deal_id": str(deal.id)}
-                    checkout_url = stripe.create_checkout_session(deal.id, deal.title, milestone.amount, deal.currency, f"{base_url}/success.html", f"{base_url}/cancel.html", 0, meta)
-                    await query.message.reply_text("Click below to fund the milestone:", reply_markup=checkout_keyboard(checkout_url))
-            elif action == "release_milestone":
-                if user.id != deal.creator.telegram_id:
-                    await query.answer("Only the client can release funds.", show_alert=True)
-                elif not deal.counterparty.stripe_account_id:
-                    await query.message.reply_text("Contractor has not connected their Stripe account. They must run /connect.")
-                else:
-                    stripe.transfer(milestone.amount, deal.currency, deal.counterparty.stripe_account_id, f"deal-{deal.id}")
-                    milestone.is_released = True
-                    if session.query(Milestone).filter_by(deal_id=deal.id, is_released=False).count() == 0:
-                        deal.status = "completed"
-                    session.commit()
-                    text, keyboard = milestone_project_keyboard(deal)
-                    await query.edit_message_text(text, reply_markup=keyboard, parse_mode='Markdown')
-                    await query.answer("Funds Released!")
+            await milestone_action(query, context, session, milestone, user_tg_id)
 
     # --- Generic Deal Actions ---
     elif action == "refresh_deal":
-        deal = session.get(Deal, entity_id)
+        await query.answer()
+        deal = session.get(Deal, entity_id, options=_DEAL_DASHBOARD)
         if deal:
             if deal.deal_type == 'milestone':
                 text, keyboard = milestone_project_keyboard(deal)
             else:
                 text = f"Trade #{deal.id} Status: {deal.trade_status or 'Unknown'}"
                 keyboard = trade_in_progress_keyboard(deal)
-            await query.edit_message_text(text, reply_markup=keyboard, parse_mode='Markdown')
-            await query.answer("Refreshed!")
+            message = query.message
+            # Nothing changed since it was drawn: skip the edit, which Telegram would reject anyway.
+            if message is None or message.text_html != text.strip() or message.reply_markup != keyboard:
+                await query.edit_message_text(text, reply_markup=keyboard, parse_mode='HTML')
 
-    session.close()
+    else:
+        await query.answer()
 
 # --- Rating Handler ---
-async def rating_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_session
+async def rating_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     query = update.callback_query
     await query.answer()
-    parts = query.data.split(":")
-    action = parts[0]
-
-    if action == "skip_rating":
+    if query.data.startswith("skip_rating"):
         await query.edit_message_text("Rating skipped.")
         return
 
-    _, deal_id_str, reviewee_id_str, rating_str = parts
-    session = DB.session()
-    reviewer = _get_or_create_user(session, update.effective_user)
-    existing_review = session.query(Review).filter_by(deal_id=int(deal_id_str), reviewer_id=reviewer.id).first()
-    if existing_review:
+    # "rate:deal_id:reviewee_id:stars"
+    _, deal_id, reviewee_id, rating = query.data.split(":", 3)
+    deal_id, reviewee_id, rating = int(deal_id), int(reviewee_id), int(rating)
+    if not 1 <= rating <= 5:
+        return
+    # Checked by Telegram id through a join, so the common "already reviewed" exit is one
+    # EXISTS query; it stops at the first matching row and doesn't build a Review object.
+    already_reviewed = session.scalar(
+        select(exists().where(
+            Review.deal_id == deal_id,
+            Review.reviewer_id == User.id,
+            User.telegram_id == update.effective_user.id,
+        ))
+    )
+    if already_reviewed:
         await query.edit_message_text("You have already left a review for this trade.")
     else:
-        new_review = Review(
-            deal_id=int(deal_id_str),
-            reviewer_id=reviewer.id,
-            reviewee_id=int(reviewee_id_str),
-            rating=int(rating_str)
-        )
-        session.add(new_review)
+        reviewer = _get_or_create_user(session, update.effective_user)
+        session.add(Review(deal_id=deal_id, reviewer_id=reviewer.id, reviewee_id=reviewee_id, rating=rating))
         session.commit()
-        await query.edit_message_text(f"Thank you! You left a {'⭐'*int(rating_str)} rating.")
-    session.close()
+        _invalidate_user_cache(context, reviewee_id)
+        await query.edit_message_text(f"Thank you! You left a {STARS[rating]} rating.")
+
+# --- Callback Routing ---
+async def noop_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Acknowledges purely informational buttons such as 'Dispute Under Review'."""
+    await update.callback_query.answer()
+
+# Callback-data prefix -> handler. Anything not listed goes to button_handler.
+CALLBACK_ROUTES = {
+    "rate": rating_handler,
+    "skip_rating": rating_handler,
+    "noop": noop_handler,
+}
+
+async def dispatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Routes every button press that isn't a conversation entry point with a
+    single dict lookup on its prefix, instead of trying regex patterns in turn.
+    """
+    prefix = update.callback_query.data.partition(":")[0]
+    handler = CALLBACK_ROUTES.get(prefix, button_handler)
+    return await handler(update, context)
 
 # --- Profile & Standalone Commands ---
-async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    session = DB.session()
+@with_session
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     message = update.message or update.callback_query.message
     target_user = None
+    cache = context.bot_data.get("user_cache")
+
+    # Own profile, already rendered, and the user hasn't been renamed since: no SQL at all.
+    own = None if context.args else _USER_PKS.get(update.effective_user.id)
+    if cache is not None and own is not None and own[1] == update.effective_user.username:
+        profile_text = cache.get(own[0])
+        if profile_text is not None:
+            await message.reply_text(profile_text, parse_mode='HTML')
+            return
 
     if context.args:
         username_to_find = context.args[0].lstrip('@')
-        target_user = session.query(User).filter(User.username.ilike(username_to_find)).first()
+        target_user = _find_user_by_username(session, username_to_find)
         if not target_user:
             await message.reply_text(f"User @{username_to_find} not found.")
-            session.close()
             return
     else:
         target_user = _get_or_create_user(session, update.effective_user)
+        session.commit()
 
-    completed_deals = session.query(Deal).filter(((Deal.creator_id == target_user.id) | (Deal.counterparty_id == target_user.id)), Deal.status == 'completed').count()
-    avg_rating, total_ratings = session.query(func.avg(Review.rating), func.count(Review.id)).filter(Review.reviewee_id == target_user.id).first()
-    recent_reviews = session.query(Review).filter(Review.reviewee_id == target_user.id).order_by(desc(Review.created)).limit(3).all()
+    profile_text = cache.get(target_user.id) if cache is not None else None
+    if profile_text is not None:
+        await message.reply_text(profile_text, parse_mode='HTML')
+        return
 
-    profile_text = f"**User Profile for @{target_user.username}**\n"
-    if target_user.is_verified: profile_text += "✅ **Verified User**\n"
-    profile_text += "-----------------------------------\n"
-    profile_text += f"**Completed Trades:** {completed_deals}\n"
-    profile_text += f"**Free Trades Remaining:** {target_user.free_trades_remaining}\n"
-    profile_text += f"**Average Rating:** {f'{avg_rating:.2f} ⭐ ({total_ratings} ratings)' if total_ratings and avg_rating else 'No ratings yet.'}\n\n"
-    profile_text += "**Recent Reviews:**\n"
-    profile_text += '\n'.join([f"- {'⭐'*r.rating} from @{r.reviewer.username}" for r in recent_reviews]) if recent_reviews else "- No recent reviews.\n"
+    # Everything comes back in one round trip: the aggregates as scalar columns, LEFT JOINed
+    # to the last three reviews, so there is always at least one row (with NULL review
+    # columns when the user has none) and every row repeats the same aggregates.
+    review_agg = select(
+        func.avg(Review.rating).label("avg_rating"), func.count(Review.id).label("total_ratings")
+    ).where(Review.reviewee_id == target_user.id).subquery()
+    recent = (
+        select(Review.rating, Review.created, User.username)
+        .join(User, Review.reviewer_id == User.id)
+        .where(Review.reviewee_id == target_user.id)
+        .order_by(desc(Review.created)).limit(3)
+        .subquery()
+    )
+    rows = session.execute(
+        select(
+            review_agg.c.avg_rating, review_agg.c.total_ratings, recent.c.rating, recent.c.username,
+        )
+        .select_from(review_agg).outerjoin(recent, true())
+        .order_by(desc(recent.c.created))
+    ).all()
+    avg_rating, total_ratings = rows[0][:2]
+    recent_reviews = [(rating, username) for *_, rating, username in rows if rating is not None]
 
-    await message.reply_text(profile_text, parse_mode='Markdown')
-    session.close()
+    parts = [f"<b>User Profile for @{escape(target_user.username or '')}</b>"]
+    if target_user.is_verified:
+        parts.append("✅ <b>Verified User</b>")
+    parts += [
+        "-----------------------------------",
+        f"<b>Completed Trades:</b> {target_user.completed_deals_count or 0}",
+        f"<b>Free Trades Remaining:</b> {target_user.free_trades_remaining}",
+        f"<b>Average Rating:</b> {f'{avg_rating:.2f} ⭐ ({total_ratings} ratings)' if total_ratings and avg_rating else 'No ratings yet.'}",
+        "",
+        "<b>Recent Reviews:</b>",
+    ]
+    if recent_reviews:
+        parts.extend(f"- {STARS[min(rating, 5)]} from @{escape(username or '')}" for rating, username in recent_reviews)
+    else:
+        parts.append("- No recent reviews.\n")
+    profile_text = "\n".join(parts)
+    if cache is not None:
+        cache[target_user.id] = profile_text
 
-async def connect_stripe(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    session = DB.session()
+    await message.reply_text(profile_text, parse_mode='HTML')
+
+@with_session
+async def connect_stripe(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     user = _get_or_create_user(session, update.effective_user)
     message = update.message or update.callback_query.message
 
+    # Saves a new or renamed user, and ends the transaction so its pooled
+    # connection isn't held across the Stripe calls below.
+    session.commit()
+
     if user.stripe_account_id:
         await message.reply_text("Your Stripe account is already connected.")
     else:
-        stripe: StripeHelper = context.bot_data["stripe"]
-        base_url = os.environ["BASE_URL"]
-        account_id = stripe.create_express_account()
+        stripe: StripeHelper = context.bot_data["services"].stripe
+        config = context.bot_data["config"]
+        account_id = await stripe.create_express_account()
         user.stripe_account_id = account_id
         session.commit()
-        return_url = f"{base_url}/success.html"
-        refresh_url = f"{base_url}/cancel.html"
-        onboarding_link = stripe.onboarding_url(account_id, refresh_url, return_url)
+        onboarding_link = await stripe.onboarding_url(account_id, config.cancel_url, config.success_url)
         await message.reply_text("Please connect your Stripe account to receive payments.", reply_markup=onboarding_keyboard(onboarding_link))
-    session.close()
 
 # --- Admin Commands ---
-async def admin_verify(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_session
+async def admin_verify(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     if not context.args:
         await update.message.reply_text("Usage: /admin_verify @username")
         return
     
     username = context.args[0].lstrip('@')
-    session = DB.session()
-    user = session.query(User).filter(User.username.ilike(username)).first()
+    # Only the three columns used below, and a Core UPDATE: no User object is built.
+    user = session.execute(
+        select(User.id, User.telegram_id, User.username).where(_username_is(username)).limit(1)
+    ).first()
     if not user:
         await update.message.reply_text(f"User @{username} not found.")
     else:
-        user.is_verified = True
+        session.execute(sql_update(User).where(User.id == user.id).values(is_verified=True))
         session.commit()
+        _invalidate_user_cache(context, user.id)
+        _in_background(context, context.bot.send_message(chat_id=user.telegram_id, text="Congratulations! You have been granted 'Verified' status by an admin."))
         await update.message.reply_text(f"✅ User @{user.username} has been verified.")
-        await context.bot.send_message(chat_id=user.telegram_id, text="Congratulations! You have been granted 'Verified' status by an admin.")
-    session.close()
 
-async def admin_split_funds(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        _, deal_id_str, seller_amount_str = context.args
-        deal_id = int(deal_id_str)
-        seller_amount = float(seller_amount_str)
-    except (ValueError, IndexError):
+@with_session
+async def admin_split_funds(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    # context.args holds only the words after the command: [deal_id, amount_to_seller].
+    args = context.args or []
+    seller_amount = _parse_money(args[1]) if len(args) == 2 and args[0].isdecimal() else None
+    if seller_amount is None:
         await update.message.reply_text("Usage: /admin_split [deal_id] [amount_to_seller]")
         return
+    deal_id = int(args[0])
 
-    session = DB.session()
-    deal = session.get(Deal, deal_id)
+    deal = session.get(Deal, deal_id, options=_DEAL_WITH_PARTIES)
 
     if not deal or not deal.payment_intent_id:
         await update.message.reply_text("Deal not found or not funded.")
-        session.close()
+        return
+    if deal.status == "completed":
+        await update.message.reply_text(f"Deal #{deal.id} is already completed.")
         return
     if seller_amount < 0 or seller_amount > deal.total_amount:
         await update.message.reply_text("Invalid amount. Must be between 0 and the total deal amount.")
-        session.close()
+        return
+    # A split that was started stays at its amount: its finished steps can't be undone.
+    if deal.split_seller_amount is not None and deal.split_seller_amount != seller_amount:
+        await update.message.reply_text(
+            f"A split paying ${deal.split_seller_amount:.2f} to the payee was already started for this deal. "
+            f"Run /admin_split {deal.id} {deal.split_seller_amount:.2f} to finish it."
+        )
         return
 
-    stripe: StripeHelper = context.bot_data["stripe"]
+    stripe: StripeHelper = context.bot_data["services"].stripe
     buyer_refund_amount = deal.total_amount - seller_amount
     
     try:
         # For milestone deals, the "seller" is the counterparty (contractor)
         payee = deal.counterparty if deal.deal_type == 'milestone' else deal.creator
         
-        if seller_amount > 0:
-            stripe.transfer(seller_amount, deal.currency, payee.stripe_account_id, f"deal-{deal.id}")
-        if buyer_refund_amount > 0:
-            stripe.refund_payment(deal.payment_intent_id, int(buyer_refund_amount * 100))
+        # Records the split before any money moves, and ends the transaction so its pooled
+        # connection isn't held across the Stripe calls.
+        deal.split_seller_amount = seller_amount
+        session.commit()
+        # The transfer and the refund are independent, so both Stripe calls run at once.
+        # A step whose id is already recorded went through on an earlier run and is skipped.
+        payouts = {}
+        if seller_amount > 0 and not deal.split_transfer_id:
+            payouts["transfer to payee"] = ("split_transfer_id", stripe.transfer(seller_amount, deal.currency, payee.stripe_account_id, f"deal-{deal.id}", idempotency_key=f"deal-{deal.id}-split-transfer"))
+        if buyer_refund_amount > 0 and not deal.split_refund_id:
+            payouts["refund to payer"] = ("split_refund_id", stripe.refund_payment(deal.payment_intent_id, to_cents(buyer_refund_amount), idempotency_key=f"deal-{deal.id}-split-refund"))
+        results = await asyncio.gather(*(call for _, call in payouts.values()), return_exceptions=True)
+        # One step can succeed while the other fails; record what went through and tell the admin which failed.
+        failed = []
+        for (step, (column, _)), result in zip(payouts.items(), results):
+            if isinstance(result, Exception):
+                failed.append((step, result))
+            else:
+                setattr(deal, column, result)
+        session.commit()
+        if failed:
+            for step, error in failed:
+                log.error("Split for deal %s: %s failed: %s", deal.id, step, error)
+            await update.message.reply_text(
+                "⚠️ Split incomplete: " + "; ".join(f"{step} failed ({error})" for step, error in failed) + ".\n"
+                f"The deal is still open. Once the cause is fixed, run /admin_split {deal.id} {seller_amount:.2f} again: "
+                "steps that went through are recorded and won't be repeated. Stripe replays a failed request's "
+                "error for 24 hours, so if the same error comes back, retry after that."
+            )
+            return
 
-        deal.status = "completed"
+        _complete_deal(deal)
+        _invalidate_user_cache(context, deal.creator_id, deal.counterparty_id)
         deal.admin_notes = f"Dispute resolved by admin with a split. Payee gets ${seller_amount:.2f}, Payer refunded ${buyer_refund_amount:.2f}."
         session.commit()
 
@@ -583,11 +1027,11 @@ async def admin_split_funds(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"- The payee (@{payee.username}) has been paid ${seller_amount:.2f}.\n"
             f"- The payer has been refunded ${buyer_refund_amount:.2f}."
         )
-        await update.message.reply_text(f"✅ Split successful. {resolution_text}")
-        await context.bot.send_message(chat_id=deal.creator.telegram_id, text=resolution_text)
-        await context.bot.send_message(chat_id=deal.counterparty.telegram_id, text=resolution_text)
+        await _send_all(
+            update.message.reply_text(f"✅ Split successful. {resolution_text}"),
+            _send_long(context.bot, deal.creator.telegram_id, resolution_text),
+            _send_long(context.bot, deal.counterparty.telegram_id, resolution_text),
+        )
 
     except Exception as e:
-        await update.message.reply_text(f"An error occurred: {e}")
-    finally:
-        session.close()
\ No newline at end of file
+        await update.message.reply_text(f"An error occurred: {e}")
\ No newline at end of file
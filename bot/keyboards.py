@@ -1,3 +1,4 @@
+from html import escape
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from database.models import Deal
 
@@ -11,19 +12,24 @@ def main_menu_keyboard():
         [InlineKeyboardButton("🔗 Connect Stripe Account", callback_data="connect_stripe")],
     ])
 
+# The main menu never changes, so one markup instance is shared by every /start.
+MAIN_MENU_MARKUP = main_menu_keyboard()
+
 # --- One-Time Trade Keyboards ---
-def trade_confirmation_keyboard(deal_id: int):
+# Action buttons carry the Telegram id allowed to press them as a third field
+# ("action:entity_id:tg_id"), so button_handler can reject other users before any DB work.
+def trade_confirmation_keyboard(deal_id: int, creator_tg_id: int):
     """Shown to the creator of the trade before sending the offer."""
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Confirm & Send Offer", callback_data=f"send_offer:{deal_id}")],
-        [InlineKeyboardButton("🚫 Cancel", callback_data=f"cancel_deal:{deal_id}")],
+        [InlineKeyboardButton("✅ Confirm & Send Offer", callback_data=f"send_offer:{deal_id}:{creator_tg_id}")],
+        [InlineKeyboardButton("🚫 Cancel", callback_data=f"cancel_deal:{deal_id}:{creator_tg_id}")],
     ])
 
-def trade_invite_keyboard(deal_id: int):
+def trade_invite_keyboard(deal_id: int, buyer_tg_id: int):
     """Shown to the buyer when they are invited to a trade."""
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("💳 Pay via Stripe", callback_data=f"pay_trade:{deal_id}")],
-        [InlineKeyboardButton("Decline", callback_data=f"decline_trade:{deal_id}")],
+        [InlineKeyboardButton("💳 Pay via Stripe", callback_data=f"pay_trade:{deal_id}:{buyer_tg_id}")],
+        [InlineKeyboardButton("Decline", callback_data=f"decline_trade:{deal_id}:{buyer_tg_id}")],
     ])
 
 def trade_in_progress_keyboard(deal: Deal):
@@ -34,10 +40,10 @@ def trade_in_progress_keyboard(deal: Deal):
         return InlineKeyboardMarkup(keyboard)
 
     if deal.trade_status == "funded":
-        keyboard.append([InlineKeyboardButton("🚚 Mark as Shipped", callback_data=f"mark_shipped:{deal.id}")])
+        keyboard.append([InlineKeyboardButton("🚚 Mark as Shipped", callback_data=f"mark_shipped:{deal.id}:{deal.creator.telegram_id}")])
     
     if deal.trade_status == "shipped":
-        keyboard.append([InlineKeyboardButton("✅ Confirm Delivery", callback_data=f"confirm_delivery:{deal.id}")])
+        keyboard.append([InlineKeyboardButton("✅ Confirm Delivery", callback_data=f"confirm_delivery:{deal.id}:{deal.counterparty.telegram_id}")])
 
     if deal.trade_status in ["funded", "shipped"]:
          keyboard.append([InlineKeyboardButton("‼️ Raise Dispute", callback_data=f"dispute_deal:{deal.id}")])
@@ -45,58 +51,68 @@ def trade_in_progress_keyboard(deal: Deal):
     return InlineKeyboardMarkup(keyboard)
 
 # --- Milestone Project Keyboard ---
+STATUS_EMOJI = {
+    "pending": "⏳", "partially_funded": "💰", "funded": "💰",
+    "completed": "✅", "cancelled": "🚫", "disputed": "‼️",
+}
+
 def milestone_project_keyboard(deal: Deal):
-    """Generates the entire text and keyboard for a milestone project dashboard."""
-    status_emoji = {"pending": "⏳", "funded": "💰", "completed": "✅", "cancelled": "🚫", "disputed": "‼️"}
-    deal_status = deal.status
-    if deal.status == "pending" and any(m.payment_intent_id for m in deal.milestones):
-        deal_status = "partially_funded"
-        status_emoji["partially_funded"] = "💰"
-
-    text = (
-        f"**Project #{deal.id}: {deal.title}**\n"
-        f"Status: {status_emoji.get(deal_status, '')} **{deal_status.replace('_', ' ').upper()}**\n"
-        f"Client: @{deal.creator.username}\n"
-        f"Contractor: @{deal.counterparty.username}\n"
-        f"Total: ${deal.total_amount:.2f} {deal.currency.upper()}\n"
-    )
-    if deal.status == "disputed":
-        text += f"\n**This project is currently in dispute. All actions are locked.**\n"
-
-    text += "-----------------------------------\n**Milestones:**\n"
+    """Generates the entire text (HTML) and keyboard for a milestone project dashboard."""
+    disputed = deal.status == "disputed"
+    creator_tg_id = deal.creator.telegram_id
+    milestone_lines = []
     keyboard = []
-    has_funded_milestones = False
+    any_deposited = has_funded_milestones = False
 
-    for ms in sorted(deal.milestones, key=lambda m: m.id):
+    # One pass over the milestones; Deal.milestones is already ordered by id in SQL.
+    for ms in deal.milestones:
         button = None
+        if ms.payment_intent_id:
+            any_deposited = True
         if ms.is_released:
             status = "✅ Released"
         elif ms.payment_intent_id:
             status = "💰 Funded"
             has_funded_milestones = True
-            if deal.status != "disputed":
-                button = InlineKeyboardButton(f"Release ${ms.amount:.2f}", callback_data=f"release_milestone:{ms.id}")
+            if not disputed:
+                button = InlineKeyboardButton(f"Release ${ms.amount:.2f}", callback_data=f"release_milestone:{ms.id}:{creator_tg_id}")
         else:
             status = "⏳ Pending"
-            if deal.status != "disputed":
-                button = InlineKeyboardButton(f"Deposit ${ms.amount:.2f}", callback_data=f"deposit_milestone:{ms.id}")
-        
-        text += f"- (ID: {ms.id}) {ms.name} (${ms.amount:.2f}): **{status}**\n"
+            if not disputed:
+                button = InlineKeyboardButton(f"Deposit ${ms.amount:.2f}", callback_data=f"deposit_milestone:{ms.id}:{creator_tg_id}")
+
+        milestone_lines.append(f"- (ID: {ms.id}) {escape(ms.name)} (${ms.amount:.2f}): <b>{status}</b>\n")
         if button:
             keyboard.append([button])
 
+    deal_status = "partially_funded" if deal.status == "pending" and any_deposited else deal.status
+    parts = [
+        f"<b>Project #{deal.id}: {escape(deal.title)}</b>\n",
+        f"Status: {STATUS_EMOJI.get(deal_status, '')} <b>{deal_status.replace('_', ' ').upper()}</b>\n",
+        f"Client: @{escape(deal.creator.username or '')}\n",
+        f"Contractor: @{escape(deal.counterparty.username or '')}\n",
+        f"Total: ${deal.total_amount:.2f} {deal.currency.upper()}\n",
+    ]
+    if disputed:
+        parts.append("\n<b>This project is currently in dispute. All actions are locked.</b>\n")
+    parts.append("-----------------------------------\n<b>Milestones:</b>\n")
+    parts.extend(milestone_lines)
+
     control_buttons = [InlineKeyboardButton("🔄 Refresh", callback_data=f"refresh_deal:{deal.id}")]
     if deal.status not in ["completed", "cancelled", "disputed"] and has_funded_milestones:
         control_buttons.append(InlineKeyboardButton("‼️ Dispute Project", callback_data=f"dispute_deal:{deal.id}"))
     keyboard.append(control_buttons)
-    
-    return text, InlineKeyboardMarkup(keyboard)
+
+    return "".join(parts), InlineKeyboardMarkup(keyboard)
 
 # --- Other Keyboards ---
+# Star strings for ratings 0-5, built once and shared with the handlers' rating text.
+STARS = tuple("⭐" * n for n in range(6))
+
 def rating_keyboard(deal_id: int, reviewee_id: int):
     """Generates a keyboard for leaving a 1-5 star rating."""
     star_buttons = [
-        InlineKeyboardButton(f"{'⭐'*i}", callback_data=f"rate:{deal_id}:{reviewee_id}:{i}")
+        InlineKeyboardButton(STARS[i], callback_data=f"rate:{deal_id}:{reviewee_id}:{i}")
         for i in range(1, 6)
     ]
     return InlineKeyboardMarkup([star_buttons, [InlineKeyboardButton("Skip", callback_data=f"skip_rating:{deal_id}")]])
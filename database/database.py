@@ -1,20 +1,117 @@
+import os
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, func, inspect, or_, select, text, update
+from sqlalchemy.orm import sessionmaker, scoped_session, raiseload
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateIndex
+from .models import Base, Deal, User
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
-from .models import Base
+def _set_sqlite_pragmas(dbapi_conn, _record):
+    """WAL lets readers proceed while a writer is active; the rest trade durability on power loss for speed."""
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+def _strict_loading(execute_state):
+    """Makes any relationship a query didn't explicitly load raise instead of lazy-loading."""
+    if execute_state.is_select and not execute_state.is_column_load and not execute_state.is_relationship_load:
+        execute_state.statement = execute_state.statement.options(raiseload("*"))
+
+def _upgrade_schema(engine):
+    """Adds the columns and indexes that create_all() skips on tables that already exist.
+
+    Safe to run on every start: anything already present is left alone. New columns are
+    added nullable, without their constraints, and completed_deals_count is backfilled.
+    """
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}"))
+            # IF NOT EXISTS rather than checkfirst: reflection can't see expression indexes
+            # such as lower(username).
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+        # Users from before completed_deals_count existed (NULL there) get their count from
+        # the deals table once; _complete_deal keeps it current from then on.
+        completed = (
+            select(func.count()).select_from(Deal)
+            .where(Deal.status == "completed", or_(Deal.creator_id == User.id, Deal.counterparty_id == User.id))
+            .scalar_subquery()
+        )
+        conn.execute(update(User).where(User.completed_deals_count.is_(None)).values(completed_deals_count=completed))
 
 class DB:
     _engine = None
     _Session = None
+    _scoped = None
 
     @classmethod
     def init(cls, url: str):
-        cls._engine = create_engine(url, future=True)
+        is_sqlite = url.startswith("sqlite")
+        if is_sqlite:
+            # The bot, webhook server and scheduler all share the engine from different threads.
+            engine_kwargs = {"connect_args": {"check_same_thread": False}}
+            if url in ("sqlite://", "sqlite:///:memory:"):
+                # An in-memory database only exists on its one connection.
+                engine_kwargs["poolclass"] = StaticPool
+        else:
+            engine_kwargs = {
+                "pool_size": int(os.getenv("DB_POOL_SIZE", "20")),
+                "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+                "pool_timeout": 30,
+                # Replace connections before server-side idle timeouts (or a proxy) drop them.
+                "pool_recycle": 1800,
+                "pool_pre_ping": True,
+            }
+
+        cls._engine = create_engine(url, future=True, **engine_kwargs)
+        if is_sqlite:
+            event.listen(cls._engine, "connect", _set_sqlite_pragmas)
         Base.metadata.create_all(cls._engine)
-        cls._Session = scoped_session(sessionmaker(bind=cls._engine, autoflush=False))
+        _upgrade_schema(cls._engine)
+        # Not a scoped_session: concurrent handlers all run on the bot's one thread,
+        # so a thread-local session would be shared (and closed) between them.
+        cls._Session = sessionmaker(bind=cls._engine, autoflush=False)
+        # The Flask side, by contrast, serves each request on its own Waitress thread.
+        cls._scoped = scoped_session(cls._Session)
+        # Development aid: surface N+1 lazy loads as errors rather than silent extra SELECTs.
+        if os.getenv("ESCROW_STRICT_LOADING") == "1":
+            event.listen(cls._Session, "do_orm_execute", _strict_loading)
 
     @classmethod
-    def session(cls):
+    def session(cls, **overrides):
+        """Returns a new session; the caller is responsible for closing it.
+
+        Keyword overrides (e.g. expire_on_commit=False) are passed to the sessionmaker.
+        """
         if cls._Session is None:
             raise RuntimeError("DB not initialised")
-        return cls._Session()
+        return cls._Session(**overrides)
+
+    @classmethod
+    def scoped(cls):
+        """Returns the thread-local session registry for the web server; call .remove() when a request ends."""
+        if cls._scoped is None:
+            raise RuntimeError("DB not initialised")
+        return cls._scoped
+
+    @classmethod
+    @contextmanager
+    def session_scope(cls, **overrides):
+        """Yields a new session, rolling it back if the block raises and always closing it."""
+        session = cls.session(**overrides)
+        try:
+            yield session
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            session.close()
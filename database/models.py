@@ -1,5 +1,5 @@
 
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Boolean, DateTime, Text
+from sqlalchemy import func, Column, Integer, String, Numeric, ForeignKey, Boolean, DateTime, Text, Index
 from sqlalchemy.orm import declarative_base, relationship
 import datetime as dt
 
@@ -13,6 +13,7 @@ class User(Base):
     stripe_account_id = Column(String, unique=True)
     is_verified = Column(Boolean, default=False)
     free_trades_remaining = Column(Integer, default=0)
+    completed_deals_count = Column(Integer, default=0)  # Kept in step with deals reaching 'completed'
     created = Column(DateTime, default=dt.datetime.utcnow)
 
     reviews_given = relationship("Review", foreign_keys="[Review.reviewer_id]", back_populates="reviewer")
@@ -20,6 +21,9 @@ class User(Base):
     referrals_made = relationship("Referral", foreign_keys="[Referral.referrer_id]", back_populates="referrer")
     referral_received = relationship("Referral", foreign_keys="[Referral.referred_user_id]", uselist=False, back_populates="referred_user")
 
+    # Backs case-insensitive @username lookups (lower(username) = :name).
+    __table_args__ = (Index("ix_users_username_lower", func.lower(username)),)
+
 class Deal(Base):
     __tablename__ = "deals"
     id = Column(Integer, primary_key=True)
@@ -27,31 +31,51 @@ class Deal(Base):
     counterparty_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     title = Column(String, nullable=False)
     currency = Column(String, default="usd")
-    total_amount = Column(Float, nullable=False)
+    total_amount = Column(Numeric(10, 2), nullable=False)  # Money: read back as Decimal
     status = Column(String, default="pending")
     deal_type = Column(String, default="milestone")
     trade_status = Column(String)
     payment_intent_id = Column(String)  # ADDED
     admin_notes = Column(Text)
+    # The deal's pending timed action ("expire_offer", "check_unconfirmed_deliveries", ...)
+    # and when it is due; scheduler.sweep() runs it.
     auto_job_id = Column(String)
+    auto_job_at = Column(DateTime)
+    # Progress of an admin split: the payee's share, and the Stripe ids of the steps done so far.
+    split_seller_amount = Column(Numeric(10, 2))
+    split_transfer_id = Column(String)
+    split_refund_id = Column(String)
     created = Column(DateTime, default=dt.datetime.utcnow)
 
     creator = relationship("User", foreign_keys=[creator_id])
     counterparty = relationship("User", foreign_keys=[counterparty_id])
     reviews = relationship("Review", back_populates="deal")
     disputes = relationship("Dispute", back_populates="deal")
+    milestones = relationship("Milestone", back_populates="deal", order_by="Milestone.id")
+
+    # One index per side of "this user's deals with status X": an OR across both columns can
+    # BitmapOr them on Postgres, and each side of a UNION ALL is a plain index lookup.
+    __table_args__ = (
+        Index("ix_deals_creator_status", "creator_id", "status"),
+        Index("ix_deals_counterparty_status", "counterparty_id", "status"),
+        # The sweeper's "auto_job_at <= now" range scan.
+        Index("ix_deals_auto_job_at", "auto_job_at"),
+    )
 
 class Milestone(Base):
     __tablename__ = "milestones"
     id = Column(Integer, primary_key=True)
     deal_id = Column(Integer, ForeignKey("deals.id"), nullable=False)
     name = Column(String, nullable=False)
-    amount = Column(Float, nullable=False)
+    amount = Column(Numeric(10, 2), nullable=False)
     payment_intent_id = Column(String)
     transfer_id = Column(String)
     is_released = Column(Boolean, default=False)
     created = Column(DateTime, default=dt.datetime.utcnow)
-    deal = relationship("Deal")
+    deal = relationship("Deal", back_populates="milestones")
+
+    # Serves the selectinload of Deal.milestones (deal_id IN ...) and unreleased-milestone checks.
+    __table_args__ = (Index("ix_milestones_deal_released", "deal_id", "is_released"),)
 
 class Review(Base):
     __tablename__ = "reviews"
@@ -67,6 +91,9 @@ class Review(Base):
     reviewer = relationship("User", foreign_keys=[reviewer_id], back_populates="reviews_given")
     reviewee = relationship("User", foreign_keys=[reviewee_id], back_populates="reviews_received")
 
+    # Serves profile's per-user rating aggregate and its "last 3 reviews" ORDER BY created.
+    __table_args__ = (Index("ix_reviews_reviewee_created", "reviewee_id", "created"),)
+
 class Referral(Base):
     __tablename__ = "referrals"
     id = Column(Integer, primary_key=True)
@@ -88,4 +115,4 @@ class Dispute(Base):
     created = Column(DateTime, default=dt.datetime.utcnow)
 
     deal = relationship("Deal", back_populates="disputes")
-    raised_by = relationship("User")
+    raised_by = relationship("User", foreign_keys=[raised_by_id])
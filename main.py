@@ -12,19 +12,22 @@ DB.init(db_url)
 
 # 3. NOW, it's safe to import the rest of the application components.
 from waitress import serve
-from bot.bot import build_app
+from bot.bot import build_app, run_app
 from webhooks.server import create_flask_app
 
 def run_bot(app):
-    """Starts the Telegram bot's polling loop."""
-    print("Bot is polling for messages...")
-    app.run_polling()
+    """Starts the Telegram bot (webhook if WEBHOOK_URL is set, long polling otherwise)."""
+    print("Bot is receiving updates via " + ("webhook..." if os.getenv("WEBHOOK_URL") else "polling..."))
+    run_app(app)
 
 def run_webhook_server(app):
     """Starts the web server for Stripe webhooks and the admin panel."""
     port = int(os.getenv("PORT", "8080"))
     print(f"Webhook server and admin dashboard running on http://0.0.0.0:{port}")
-    serve(app, host="0.0.0.0", port=port)
+    # A Stripe webhook holds a worker thread only until its DB commit (Telegram sends are handed
+    # to the sender loop), but admin dashboard pages hold one through all their queries; more
+    # than Waitress's default of 4 keeps a few slow pages from delaying webhook acknowledgements.
+    serve(app, host="0.0.0.0", port=port, threads=int(os.getenv("WAITRESS_THREADS", "8")))
 
 if __name__ == "__main__":
     # Build the Telegram bot application.
@@ -35,9 +38,8 @@ if __name__ == "__main__":
     flask_app = create_flask_app()
     
     # NOTE: We no longer create a separate scheduler.
-    # The `app` object's built-in `job_queue` is automatically passed to all handlers
-    # via the `context` object (as `context.job_queue`).
-    # Our existing code in `handlers.py` and `scheduler.py` already uses this correctly.
+    # build_app() registers scheduler.sweep on the `app` object's built-in `job_queue`;
+    # the timed deal actions it runs are stored in the database.
 
     # Run the Flask web server in a separate thread
     threading.Thread(target=run_webhook_server, args=(flask_app,), daemon=True).start()
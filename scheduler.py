@@ -1,74 +1,158 @@
+import asyncio
 import logging
-from datetime import datetime
-from telegram.ext import Application
+import datetime as dt
+from typing import TYPE_CHECKING
+from sqlalchemy import select, update
+from telegram.ext import ContextTypes, JobQueue
 
 from database.database import DB
 from database.models import Deal
-from stripe_utils.stripe_utils import StripeHelper
+
+if TYPE_CHECKING:
+    from stripe_utils.stripe_utils import StripeHelper
 
 log = logging.getLogger(__name__)
 
-def schedule_job(job_queue, job_id: str, deal_id: int, job_type: str, run_time: datetime):
-    """Adds a job to the APScheduler queue."""
-    job_queue.run_once(run_scheduled_job, run_time, context={'deal_id': deal_id, 'job_type': job_type}, name=job_id)
-    log.info(f"Scheduled job '{job_id}' for deal {deal_id} to run at {run_time}.")
-
-def remove_job(job_queue, job_id: str):
-    """Removes a job from the queue by its name (ID)."""
-    if not job_id: return
-    jobs = job_queue.get_jobs_by_id(job_id)
-    if jobs:
-        for job in jobs:
-            job.schedule_removal()
-        log.info(f"Removed scheduled job '{job_id}'.")
-
-async def run_scheduled_job(context: Application):
-    """The callback function that APScheduler executes."""
-    # THIS IS THE FIX: The import is moved inside the function to break the circular dependency.
-    from bot.handlers import _prompt_for_ratings 
+# How often the sweeper looks for due deal actions, how many it takes per tick, and how
+# many of those run (Stripe call plus notifications) at once.
+SWEEP_INTERVAL = 60
+SWEEP_BATCH = 100
+SWEEP_CONCURRENCY = 10
+# How long a failed action (e.g. a Stripe error) waits before the sweeper tries it again.
+RETRY_DELAY = dt.timedelta(minutes=15)
 
-    job_context = context.job.context
-    deal_id = job_context['deal_id']
-    job_type = job_context['job_type']
-    
-    session = DB.session()
-    try:
-        deal = session.get(Deal, deal_id)
-        if not deal:
-            log.info(f"Scheduled job for deal {deal_id} is no longer relevant (deal not found).")
+def schedule_job(deal: Deal, job_type: str, delay: dt.timedelta):
+    """
+    Records a timed action on the deal, replacing any pending one. It is stored in the deals
+    table (durable once the caller commits), and sweep() runs it once delay has passed.
+    """
+    deal.auto_job_id = job_type
+    deal.auto_job_at = dt.datetime.utcnow() + delay
+    log.info("Scheduled '%s' for deal %s in %s.", job_type, deal.id, delay)
+
+def remove_job(deal: Deal):
+    """Cancels the deal's pending timed action, if any; takes effect with the caller's commit."""
+    deal.auto_job_id = None
+    deal.auto_job_at = None
+
+def start_sweeper(job_queue: JobQueue):
+    """Registers sweep() as one repeating job, however many deals have actions pending."""
+    job_queue.run_repeating(sweep, interval=SWEEP_INTERVAL, first=SWEEP_INTERVAL, name="deal_sweeper")
+
+async def sweep(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Runs every deal action that has come due. One indexed query per tick finds them, and
+    because the schedule lives in the database, actions due while the bot was down run on
+    the first tick after a restart.
+    """
+    now = dt.datetime.utcnow()
+    with DB.session_scope() as session:
+        due = session.execute(
+            select(Deal.id, Deal.auto_job_id)
+            .where(Deal.auto_job_at <= now)
+            .order_by(Deal.auto_job_at)
+            .limit(SWEEP_BATCH)
+        ).all()
+        if not due:
             return
+        # Claimed before running, so each action runs at most once even if a tick overlaps.
+        session.execute(
+            update(Deal)
+            .where(Deal.id.in_([deal_id for deal_id, _ in due]), Deal.auto_job_at <= now)
+            .values(auto_job_id=None, auto_job_at=None)
+        )
+        session.commit()
 
-        log.info(f"Running scheduled job '{job_type}' for deal {deal_id}.")
-        stripe: StripeHelper = context.application.bot_data['stripe']
+    limit = asyncio.Semaphore(SWEEP_CONCURRENCY)
+    async def run(deal_id: int, job_type: str):
+        async with limit:
+            await run_deal_job(context, deal_id, job_type)
+    await asyncio.gather(*(run(deal_id, job_type) for deal_id, job_type in due))
 
-        if job_type == "expire_offer" and deal.status == 'pending':
-            deal.status = 'cancelled'
-            deal.admin_notes = 'Offer expired after 24 hours without payment.'
-            session.commit()
-            await context.bot.send_message(chat_id=deal.creator.telegram_id, text=f"Your trade offer for '{deal.title}' has expired as the buyer did not pay within 24 hours.")
+async def run_deal_job(context: ContextTypes.DEFAULT_TYPE, deal_id: int, job_type: str):
+    """
+    Carries out one timed action, if the deal is still in the state it was scheduled for.
+    If it fails, it is rescheduled RETRY_DELAY later.
+    """
+    # THIS IS THE FIX: The import is moved inside the function to break the circular dependency.
+    from bot.handlers import _prompt_for_ratings, _send_all, _complete_deal, _unclaim_release, _DEAL_WITH_PARTIES, _RELEASE_LOCKED
 
-        elif job_type == "check_unshipped_trades" and deal.trade_status == 'funded':
-            stripe.refund_payment(deal.payment_intent_id)
-            deal.status = 'cancelled'
-            deal.trade_status = 'refunded'
-            deal.admin_notes = 'Automatically refunded buyer as seller did not ship within 7 days.'
-            session.commit()
-            refund_text = f"Deal #{deal.id} for '{deal.title}' has been automatically cancelled and the buyer refunded because the seller did not mark it as shipped within 7 days."
-            await context.bot.send_message(chat_id=deal.creator.telegram_id, text=refund_text)
-            await context.bot.send_message(chat_id=deal.counterparty.telegram_id, text=refund_text)
-
-        elif job_type == "check_unconfirmed_deliveries" and deal.trade_status == 'shipped':
-            stripe.transfer(deal.total_amount, deal.currency, deal.creator.stripe_account_id, f"deal-{deal.id}")
-            deal.status = 'completed'
-            deal.trade_status = 'completed'
-            deal.admin_notes = 'Automatically released funds to seller as buyer did not confirm delivery within 7 days.'
+    try:
+        with DB.session_scope(expire_on_commit=False) as session:
+            deal = session.get(Deal, deal_id, options=_DEAL_WITH_PARTIES)
+            if not deal:
+                log.info("Scheduled job for deal %s is no longer relevant (deal not found).", deal_id)
+                return
+
+            log.info("Running scheduled job '%s' for deal %s.", job_type, deal_id)
+            stripe: StripeHelper = context.application.bot_data['services'].stripe
+            # End the read transaction so its pooled connection isn't held across a Stripe call.
             session.commit()
-            release_text = f"Funds for Deal #{deal.id} ('{deal.title}') have been automatically released to the seller because delivery was not confirmed within 7 days."
-            await context.bot.send_message(chat_id=deal.creator.telegram_id, text=release_text)
-            await context.bot.send_message(chat_id=deal.counterparty.telegram_id, text=release_text)
-            await _prompt_for_ratings(context, deal)
+
+            if job_type == "expire_offer" and deal.status == 'pending':
+                # Conditional, like the webhook's pending -> funded claim: if the payment lands
+                # after the read above, exactly one of the two updates matches.
+                expired = session.execute(
+                    update(Deal)
+                    .where(Deal.id == deal.id, Deal.status == 'pending')
+                    .values(status='cancelled', admin_notes='Offer expired after 24 hours without payment.')
+                ).rowcount
+                session.commit()
+                if not expired:
+                    return
+                await context.bot.send_message(chat_id=deal.creator.telegram_id, text=f"Your trade offer for '{deal.title}' has expired as the buyer did not pay within 24 hours.")
+
+            elif job_type == "check_unshipped_trades" and deal.trade_status == 'funded':
+                await stripe.refund_payment(deal.payment_intent_id, idempotency_key=f"deal-{deal.id}-refund")
+                deal.status = 'cancelled'
+                deal.trade_status = 'refunded'
+                deal.admin_notes = 'Automatically refunded buyer as seller did not ship within 7 days.'
+                session.commit()
+                refund_text = f"Deal #{deal.id} for '{deal.title}' has been automatically cancelled and the buyer refunded because the seller did not mark it as shipped within 7 days."
+                await _send_all(
+                    context.bot.send_message(chat_id=deal.creator.telegram_id, text=refund_text),
+                    context.bot.send_message(chat_id=deal.counterparty.telegram_id, text=refund_text),
+                )
+
+            elif job_type == "check_unconfirmed_deliveries" and deal.trade_status == 'shipped':
+                # The same claim as a buyer-confirmed release, so the two paths can never both pay out.
+                claimed = session.execute(
+                    update(Deal)
+                    .where(Deal.id == deal.id, Deal.trade_status == 'shipped', Deal.status.notin_(_RELEASE_LOCKED))
+                    .values(trade_status='releasing')
+                ).rowcount
+                session.commit()
+                if not claimed:
+                    return
+                try:
+                    await stripe.transfer(deal.total_amount, deal.currency, deal.creator.stripe_account_id, f"deal-{deal.id}", idempotency_key=f"deal-{deal.id}-release")
+                except Exception:
+                    _unclaim_release(session, deal)
+                    raise
+                _complete_deal(deal)
+                deal.trade_status = 'completed'
+                deal.admin_notes = 'Automatically released funds to seller as buyer did not confirm delivery within 7 days.'
+                session.commit()
+                user_cache = context.application.bot_data.get("user_cache")
+                if user_cache is not None:
+                    user_cache.pop(deal.creator_id, None)
+                    user_cache.pop(deal.counterparty_id, None)
+                release_text = f"Funds for Deal #{deal.id} ('{deal.title}') have been automatically released to the seller because delivery was not confirmed within 7 days."
+                await _send_all(
+                    context.bot.send_message(chat_id=deal.creator.telegram_id, text=release_text),
+                    context.bot.send_message(chat_id=deal.counterparty.telegram_id, text=release_text),
+                )
+                # After the notices, so neither chat gets its rating prompt first.
+                await _prompt_for_ratings(context, deal)
 
     except Exception as e:
-        log.error(f"Error in scheduled job for deal {deal_id}: {e}")
-    finally:
-        session.close()
\ No newline at end of file
+        # sweep() cleared the action when it claimed it, so put it back for a later tick
+        # (unless something else has been scheduled on the deal meanwhile).
+        log.error("Error in scheduled job '%s' for deal %s, retrying in %s: %s", job_type, deal_id, RETRY_DELAY, e)
+        with DB.session_scope() as session:
+            session.execute(
+                update(Deal)
+                .where(Deal.id == deal_id, Deal.auto_job_id.is_(None))
+                .values(auto_job_id=job_type, auto_job_at=dt.datetime.utcnow() + RETRY_DELAY)
+            )
+            session.commit()
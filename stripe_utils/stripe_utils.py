@@ -1,20 +1,35 @@
 import stripe
+from decimal import Decimal
 from typing import Dict, Optional
 
+from utils.money import to_cents
+
+
 class StripeHelper:
-    def __init__(self, secret_key: str):
-        """Initialise the Stripe helper with the provided secret key."""
+    """
+    Thin wrapper over the Stripe calls the bot makes. The methods are coroutines
+    built on the SDK's *_async API, so a slow Stripe request doesn't block the
+    bot's event loop (and every other update with it).
+    """
+    def __init__(self, secret_key: str, http_client: Optional[stripe.HTTPClient] = None):
+        """
+        Initialise the Stripe helper with the provided secret key.
+        If an HTTP client is given it becomes the SDK's default, so all calls
+        share its pooled keep-alive connections.
+        """
         stripe.api_key = secret_key
+        if http_client is not None:
+            stripe.default_http_client = http_client
         self.stripe = stripe
 
-    def create_express_account(self) -> str:
+    async def create_express_account(self) -> str:
         """Creates a new Stripe Express account and returns its ID."""
-        acct = self.stripe.Account.create(type="express")
+        acct = await self.stripe.Account.create_async(type="express")
         return acct["id"]
 
-    def onboarding_url(self, account_id: str, refresh_url: str, return_url: str) -> str:
+    async def onboarding_url(self, account_id: str, refresh_url: str, return_url: str) -> str:
         """Creates an account link for onboarding a user."""
-        link = self.stripe.AccountLink.create(
+        link = await self.stripe.AccountLink.create_async(
             account=account_id,
             refresh_url=refresh_url,
             return_url=return_url,
@@ -22,11 +37,11 @@ class StripeHelper:
         )
         return link["url"]
 
-    def create_checkout_session(
+    async def create_checkout_session(
         self,
         deal_id: int,
         deal_title: str,
-        amount: float,
+        amount: Decimal,
         currency: str,
         success_url: str,
         cancel_url: str,
@@ -52,7 +67,7 @@ class StripeHelper:
         if application_fee_cents and application_fee_cents > 0:
             payment_intent_data["application_fee_amount"] = application_fee_cents
 
-        session = self.stripe.checkout.Session.create(
+        session = await self.stripe.checkout.Session.create_async(
             payment_method_types=["card"],
             line_items=[
                 {
@@ -62,7 +77,7 @@ class StripeHelper:
                             "name": f"Escrow for '{deal_title}'",
                             "description": f"Deal ID: {deal_id}",
                         },
-                        "unit_amount": int(amount * 100),
+                        "unit_amount": to_cents(amount),
                     },
                     "quantity": 1,
                 }
@@ -71,23 +86,40 @@ class StripeHelper:
             success_url=success_url,
             cancel_url=cancel_url,
             payment_intent_data=payment_intent_data,
+            # Also on the session itself, so checkout.session.completed carries it without
+            # a PaymentIntent lookup.
+            metadata=metadata_data,
         )
         return session.url
 
-    def transfer(self, amount: float, currency: str, destination: str, transfer_group: str) -> str:
-        """Transfer funds to a connected account."""
-        tx = self.stripe.Transfer.create(
-            amount=int(amount * 100),
+    async def transfer(
+        self,
+        amount: Decimal,
+        currency: str,
+        destination: str,
+        transfer_group: str,
+        idempotency_key: Optional[str] = None,
+    ) -> str:
+        """
+        Transfer funds to a connected account.
+        Calls sharing an idempotency key create at most one transfer, so a
+        double-pressed button can't pay out twice.
+        """
+        tx = await self.stripe.Transfer.create_async(
+            amount=to_cents(amount),
             currency=currency,
             destination=destination,
             transfer_group=transfer_group,
+            idempotency_key=idempotency_key,
         )
         return tx["id"]
 
-    def refund_payment(self, payment_intent_id: str, amount_cents: int = None) -> str:
-        """Refund all or part of a payment intent."""
+    async def refund_payment(
+        self, payment_intent_id: str, amount_cents: int = None, idempotency_key: Optional[str] = None
+    ) -> str:
+        """Refund all or part of a payment intent (at most once per idempotency key)."""
         params = {"payment_intent": payment_intent_id}
         if amount_cents:
             params["amount"] = amount_cents
-        refund = self.stripe.Refund.create(**params)
+        refund = await self.stripe.Refund.create_async(idempotency_key=idempotency_key, **params)
         return refund.id
\ No newline at end of file
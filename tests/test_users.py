@@ -0,0 +1,31 @@
+import unittest
+from types import SimpleNamespace
+
+from database.database import DB
+from database.models import User
+from bot import handlers
+
+
+class GetOrCreateUsersTest(unittest.TestCase):
+    def setUp(self):
+        DB.init("sqlite://")
+        handlers._USER_PKS.clear()
+
+    def test_duplicate_new_user_is_created_once(self):
+        # A self-trade passes the same, not yet known, user as both parties.
+        tg_user = SimpleNamespace(id=111, username="alice")
+        with DB.session_scope() as session:
+            ids = handlers._get_or_create_user_ids(session, [tg_user, tg_user])
+            self.assertIsNotNone(ids[111])
+            self.assertEqual(session.query(User).filter_by(telegram_id=111).count(), 1)
+            session.commit()
+        # Nothing was cached before the row had an id.
+        self.assertNotIn(111, handlers._USER_PKS)
+
+        with DB.session_scope() as session:
+            self.assertEqual(handlers._get_or_create_user_ids(session, [tg_user, tg_user]), ids)
+        self.assertEqual(handlers._USER_PKS[111], (ids[111], "alice"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,5 @@
+from decimal import Decimal
+
+def to_cents(amount: Decimal) -> int:
+    """Converts a dollar amount to Stripe's integer minor units, exactly."""
+    return int((Decimal(amount) * 100).to_integral_value())
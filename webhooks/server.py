@@ -1,10 +1,18 @@
 import os
+import hmac
+import time
+import hashlib
 import stripe
+from html import escape
 import logging
 import asyncio
+import threading
+import orjson
 from flask import Flask, request, abort, Response
 from flask_admin import Admin
 from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import select, update
+from sqlalchemy.orm import joinedload, selectinload
 from telegram import Bot
 
 from database.database import DB
@@ -13,11 +21,82 @@ from bot.keyboards import trade_in_progress_keyboard, milestone_project_keyboard
 
 log = logging.getLogger(__name__)
 
+# Read once at import (main.py loads .env before importing this module), not on every request.
+_ADMIN_USER = os.getenv("ADMIN_USER")
+_ADMIN_PASS = os.getenv("ADMIN_PASS")
+# The webhook's reply never changes, so its JSON body is encoded once.
+_OK_RESPONSE_BODY = orjson.dumps({"status": "ok"})
+
+# Comma-separated: the platform endpoint and a Connect endpoint each have their own secret.
+_WEBHOOK_SECRETS = tuple(
+    secret.strip() for secret in os.getenv("STRIPE_WEBHOOK_SECRET", "").split(",") if secret.strip()
+)
+_SIGNATURE_TOLERANCE = stripe.Webhook.DEFAULT_TOLERANCE
+
+# The funded-deal messages render both parties (and a project's milestones) into the keyboards.
+_DEAL_PARTIES = (joinedload(Deal.creator), joinedload(Deal.counterparty))
+_MILESTONE_DASHBOARD = (joinedload(Milestone.deal).options(*_DEAL_PARTIES, selectinload(Deal.milestones)),)
+
+def _signature_is_valid(payload: bytes, header: str) -> bool:
+    """
+    Checks a Stripe-Signature header against every configured signing secret. The header is
+    parsed and the signed payload built once, so each extra secret costs a single HMAC.
+    """
+    timestamp, signatures = None, []
+    for item in header.split(","):
+        key, _, value = item.partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1":
+            signatures.append(value)
+    if not timestamp or not timestamp.isdecimal() or not signatures:
+        return False
+    if int(timestamp) < time.time() - _SIGNATURE_TOLERANCE:
+        return False  # Too old: a replayed event.
+    signed_payload = timestamp.encode() + b"." + payload
+    for secret in _WEBHOOK_SECRETS:
+        expected = hmac.new(secret.encode(), signed_payload, hashlib.sha256).hexdigest()
+        if any(hmac.compare_digest(expected, signature) for signature in signatures):
+            return True
+    return False
+
+class _TelegramSender:
+    """
+    One Bot, and so one pooled HTTP client kept warm across webhook requests. Its client is
+    bound to the event loop that first uses it, so that loop runs for the life of the
+    process on its own thread; Waitress worker threads hand coroutines to it.
+    """
+    def __init__(self, token: str):
+        self.bot = Bot(token=token)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="telegram-sender", daemon=True).start()
+
+    def submit(self, coro):
+        """Schedules coro on the sender's loop without waiting for it."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+async def _notify_parties(bot: Bot, deal_id: int, chat_ids: tuple, **message):
+    """
+    Sends the same message to both parties of a deal concurrently. A failed send is
+    logged and doesn't stop the other.
+    """
+    results = await asyncio.gather(
+        *(bot.send_message(chat_id=chat_id, **message) for chat_id in chat_ids), return_exceptions=True
+    )
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, Exception):
+            log.warning("Telegram notification to %s for deal %s failed: %s", chat_id, deal_id, result)
+
 class AuthModelView(ModelView):
     """A ModelView protected by basic auth, for the admin panel."""
     def is_accessible(self):
         auth = request.authorization
-        return auth and auth.username == os.getenv('ADMIN_USER') and auth.password == os.getenv('ADMIN_PASS')
+        # Constant-time comparisons, so response timing doesn't leak how much of a guess matched.
+        return bool(
+            auth and _ADMIN_USER and _ADMIN_PASS
+            and hmac.compare_digest((auth.username or "").encode(), _ADMIN_USER.encode())
+            and hmac.compare_digest((auth.password or "").encode(), _ADMIN_PASS.encode())
+        )
 
     def inaccessible_callback(self, name, **kwargs):
         return Response('<h1>Login Required</h1>'
@@ -32,64 +111,99 @@ def create_flask_app():
 
     # Initialize Stripe API key for this context
     stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+    sender = _TelegramSender(os.getenv("TELEGRAM_BOT_TOKEN"))
+
+    # One thread-local session per Waitress worker, shared by the views and the webhook
+    # within a request and discarded when it ends.
+    db_session = DB.scoped()
+    app.teardown_appcontext(lambda exc: db_session.remove())
 
     # --- Admin Dashboard Setup ---
-    admin = Admin(app, name='EscrowBot Admin', template_mode='bootstrap3')
-    # This is now safe because DB.init() has already been called in main.py
-    admin.add_view(AuthModelView(User, DB.session()))
-    admin.add_view(AuthModelView(Deal, DB.session()))
-    admin.add_view(AuthModelView(Milestone, DB.session()))
-    admin.add_view(AuthModelView(Review, DB.session()))
-    admin.add_view(AuthModelView(Referral, DB.session()))
-    admin.add_view(AuthModelView(Dispute, DB.session()))
+    # Optional, so a process that only receives Stripe webhooks skips building the
+    # model views and their forms.
+    if os.getenv("ENABLE_ADMIN", "1") == "1":
+        admin = Admin(app, name='EscrowBot Admin', template_mode='bootstrap3')
+        # This is now safe because DB.init() has already been called in main.py
+        for model in (User, Deal, Milestone, Review, Referral, Dispute):
+            admin.add_view(AuthModelView(model, db_session))
+
+    def notify_parties(deal: Deal, **message):
+        """
+        Hands the parties' notifications to the sender loop and returns at once: the event is
+        acknowledged as soon as the deal is committed, not after the Telegram round trips.
+        """
+        chat_ids = (deal.creator.telegram_id, deal.counterparty.telegram_id)
+        sender.submit(_notify_parties(sender.bot, deal.id, chat_ids, **message))
 
     # --- Stripe Webhook Handler ---
     @app.route("/stripe/webhook", methods=["POST"])
     def webhook():
         """Handles incoming events from Stripe."""
-        try:
-            event = stripe.Webhook.construct_event(
-                request.data, request.headers.get("stripe-signature", ""), os.getenv("STRIPE_WEBHOOK_SECRET")
-            )
-        except (ValueError, stripe.error.SignatureVerificationError) as e:
-            log.error("Webhook signature verification failed: %s", e)
+        if not _signature_is_valid(request.data, request.headers.get("stripe-signature", "")):
+            log.error("Webhook signature verification failed.")
             return abort(400, "Invalid signature")
+        try:
+            # The body is already verified, so it is read as plain dicts (orjson; its decode error
+            # is a ValueError): no StripeObject wrapping, and .get() works on every SDK version.
+            event = orjson.loads(request.data)
+        except ValueError as e:
+            log.error("Webhook payload is not valid JSON: %s", e)
+            return abort(400, "Invalid payload")
 
-        session = DB.session()
+        session = db_session()
         
         if event["type"] == "checkout.session.completed":
             session_data = event["data"]["object"]
             payment_intent_id = session_data.get("payment_intent")
-            pi = stripe.PaymentIntent.retrieve(payment_intent_id)
-            metadata = pi["metadata"]
-            bot = Bot(token=os.getenv("TELEGRAM_BOT_TOKEN"))
+            metadata = session_data.get("metadata") or {}
+            if 'deal_id' not in metadata:
+                # Older sessions only carry it on the PaymentIntent; newer ones skip this Stripe call.
+                metadata = stripe.PaymentIntent.retrieve(payment_intent_id)["metadata"]
 
+            # Each transition is one conditional UPDATE: a redelivered (or concurrently delivered)
+            # event matches no row, so it costs that single statement and notifies nobody twice.
             if 'milestone_id' in metadata:
-                milestone = session.get(Milestone, int(metadata['milestone_id']))
-                if milestone and not milestone.payment_intent_id:
-                    milestone.payment_intent_id = payment_intent_id
+                milestone_id = int(metadata['milestone_id'])
+                funded = session.execute(
+                    update(Milestone)
+                    .where(Milestone.id == milestone_id, Milestone.payment_intent_id.is_(None))
+                    .values(payment_intent_id=payment_intent_id)
+                ).rowcount
+                session.commit()
+                if funded:
+                    milestone = session.get(Milestone, milestone_id, options=_MILESTONE_DASHBOARD)
                     deal = milestone.deal
-                    session.commit()
                     log.info("Milestone %s for Deal %s funded.", milestone.id, deal.id)
                     text, keyboard = milestone_project_keyboard(deal)
-                    asyncio.run(bot.send_message(chat_id=deal.creator.telegram_id, text=text, reply_markup=keyboard, parse_mode='Markdown'))
-                    asyncio.run(bot.send_message(chat_id=deal.counterparty.telegram_id, text=text, reply_markup=keyboard, parse_mode='Markdown'))
+                    notify_parties(deal, text=text, reply_markup=keyboard, parse_mode='HTML')
 
             elif 'deal_id' in metadata:
-                deal = session.get(Deal, int(metadata['deal_id']))
-                if deal and deal.status == 'pending':
-                    deal.status = 'funded'
-                    deal.trade_status = 'funded'
-                    deal.payment_intent_id = payment_intent_id
-                    session.commit()
+                deal_id = int(metadata['deal_id'])
+                funded = session.execute(
+                    update(Deal)
+                    .where(Deal.id == deal_id, Deal.status == 'pending')
+                    # Funding also cancels the pending offer expiry.
+                    .values(status='funded', trade_status='funded', payment_intent_id=payment_intent_id,
+                            auto_job_id=None, auto_job_at=None)
+                ).rowcount
+                if funded and metadata.get('free_trade') == '1':
+                    # A free trade is used up here, with the funding itself, so abandoned checkouts
+                    # don't spend one and a redelivered event can't spend two.
+                    session.execute(
+                        update(User)
+                        .where(User.id == select(Deal.counterparty_id).where(Deal.id == deal_id).scalar_subquery(),
+                               User.free_trades_remaining > 0)
+                        .values(free_trades_remaining=User.free_trades_remaining - 1)
+                    )
+                session.commit()
+                if funded:
+                    deal = session.get(Deal, deal_id, options=_DEAL_PARTIES)
                     log.info("One-Time Trade Deal %s funded.", deal.id)
-                    funded_text = f"💰 **Trade Funded!**\n\nEscrow for '{deal.title}' is now funded. Seller, please ship the item and click 'Mark as Shipped'."
+                    funded_text = f"💰 <b>Trade Funded!</b>\n\nEscrow for '{escape(deal.title)}' is now funded. Seller, please ship the item and click 'Mark as Shipped'."
                     keyboard = trade_in_progress_keyboard(deal)
-                    asyncio.run(bot.send_message(chat_id=deal.creator.telegram_id, text=funded_text, reply_markup=keyboard, parse_mode='Markdown'))
-                    asyncio.run(bot.send_message(chat_id=deal.counterparty.telegram_id, text=funded_text, reply_markup=keyboard, parse_mode='Markdown'))
+                    notify_parties(deal, text=funded_text, reply_markup=keyboard, parse_mode='HTML')
 
-        session.close()
-        return {"status": "ok"}
+        return Response(_OK_RESPONSE_BODY, mimetype="application/json")
 
     # --- Static Pages for Stripe Redirects ---
     @app.route("/success.html")